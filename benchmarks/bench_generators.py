@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Per-item overhead of sessionaware generators against a bare generator, and
+what prefetching buys a consumer that computes while pages are fetched."""
+
+import time
+import timeit
+
+from collections import deque
+
+from sessionlib import Session, sessionaware
+
+
+ITEMS = 100000
+PAGES = 200
+
+
+def rows(session, n):
+    yield from range(n)
+
+
+def consume(iterable):
+    deque(iterable, maxlen=0)
+
+
+def consume_batches(iterable):
+    for chunk in iterable:
+        deque(chunk, maxlen=0)
+
+
+def main():
+    wrapped = sessionaware(rows)
+    cases = [
+        ('unwrapped generator', lambda s: consume(rows(s, ITEMS))),
+        ('sessionaware', lambda s: consume(wrapped(ITEMS))),
+    ]
+    for batch in (100, 1000):
+        batched = sessionaware(rows, batch=batch)
+        cases.append(('sessionaware batch={}'.format(batch),
+                      lambda s, b=batched: consume_batches(b(ITEMS))))
+    for prefetch in (1, 64):
+        prefetched = sessionaware(rows, prefetch=prefetch)
+        cases.append(('sessionaware prefetch={}'.format(prefetch),
+                      lambda s, p=prefetched: consume(p(ITEMS))))
+
+    print('{:<28} {:>10} {:>10}'.format('case', 'ns/item', 'overhead'))
+    with Session() as session:
+        baseline = None
+        for name, stmt in cases:
+            seconds = min(timeit.repeat(lambda: stmt(session), number=1,
+                                        repeat=5))
+            per_item = seconds / ITEMS * 1e9
+            if baseline is None:
+                baseline = per_item
+            print('{:<28} {:>10.1f} {:>10.1f}'.format(
+                name, per_item, per_item - baseline))
+
+        # Pages take 2ms to fetch and 2ms to process.
+        def fetch(session, n):
+            for i in range(n):
+                time.sleep(0.002)
+                yield i
+
+        print()
+        for name, pages in (('paged', sessionaware(fetch)),
+                            ('paged prefetch=4',
+                             sessionaware(fetch, prefetch=4))):
+            start = time.perf_counter()
+            for _ in pages(PAGES):
+                time.sleep(0.002)
+            print('{:<28} {:>10.1f} ms/page'.format(
+                name, (time.perf_counter() - start) / PAGES * 1e3))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""tracemalloc measurements of Session size and open/close allocations."""
+
+import gc
+import tracemalloc
+
+from sessionlib import Session
+
+
+SESSIONS = 10000
+CYCLES = 10000
+
+
+def _cycle(session):
+    with session:
+        pass
+    return session
+
+
+def bytes_per_session(build):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    sessions = [build() for _ in range(SESSIONS)]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    stats = after.compare_to(before, 'filename')
+    size = sum(s.size_diff for s in stats)
+    count = sum(s.count_diff for s in stats)
+    # Discount the list holding the sessions.
+    size -= sessions.__sizeof__()
+    return size / SESSIONS, (count - 1) / SESSIONS
+
+
+def open_close_cycle(subscribed):
+    session = Session()
+    if subscribed:
+        for observable in (session.on_open, session.on_enter,
+                           session.on_leave, session.on_close):
+            observable.subscribe(lambda: None)
+
+    # Warm up lazily created state before measuring.
+    with session:
+        pass
+
+    gc.collect()
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    base, _ = tracemalloc.get_traced_memory()
+    for _ in range(CYCLES):
+        with session:
+            with session:
+                pass
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return (current - base) / CYCLES, peak - base
+
+
+def main():
+    for name, build in (('new', Session),
+                        ('opened and closed', lambda: _cycle(Session()))):
+        size, blocks = bytes_per_session(build)
+        print('bytes per session, {:<18} {:>8.1f}  ({:.1f} blocks)'.format(
+            name, size, blocks))
+    for subscribed in (False, True):
+        retained, peak = open_close_cycle(subscribed)
+        print('open/enter/leave/close{:<7} retained {:>6.1f} B/cycle, '
+              'peak {:>6d} B'.format(
+                  ' (subs)' if subscribed else '', retained, peak))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Cost of the metrics layer on open/close and sessionaware calls.
+
+Three builds of the same paths are timed:
+
+- stripped: sessionlib.sessionlib recompiled with its metrics hooks removed
+  (see strip_hooks()), i.e. the code as it would be without the feature,
+- disabled: the shipped module with metrics off, the production default,
+- enabled: the shipped module with metrics on.
+
+The disabled overhead is the disabled - stripped difference. Runs of the
+stripped and disabled builds are interleaved and the fastest of each kept, so
+drift on a noisy machine affects both alike.
+"""
+
+import ast
+import importlib.util
+import sys
+import timeit
+
+from contextlib import nullcontext
+
+import sessionlib.sessionlib
+
+from sessionlib import metrics
+
+
+NUMBER = 100000
+REPEAT = 15
+
+
+# Rewrites a module so every `recorder` (and any local assigned from one, like
+# `start = recorder and perf_counter()`) is known to be None, then drops what
+# that makes dead: the hook branches, the assignments, and try/finally blocks
+# left with an empty finally.
+class _HookStripper(ast.NodeTransformer):
+    def __init__(self):
+        self.names = {'recorder'}
+
+    def _falsy(self, node):
+        if isinstance(node, ast.Attribute):
+            return node.attr == 'recorder'
+        if isinstance(node, ast.Name):
+            return node.id in self.names
+        if isinstance(node, ast.BoolOp) and isinstance(node.op, ast.And):
+            return any(self._falsy(v) for v in node.values)
+        return False
+
+    def collect(self, tree):
+        # Locals assigned from a recorder, until no new ones turn up.
+        while True:
+            found = {t.id for node in ast.walk(tree)
+                     if isinstance(node, ast.Assign) and
+                     self._falsy(node.value)
+                     for t in node.targets if isinstance(t, ast.Name)}
+            if found <= self.names:
+                return
+            self.names |= found
+
+    def _body(self, statements):
+        body = []
+        for statement in statements:
+            result = self.visit(statement)
+            if result is None:
+                continue
+            body.extend(result if isinstance(result, list) else [result])
+        return body or [ast.Pass()]
+
+    def generic_visit(self, node):
+        for field in ('body', 'orelse', 'finalbody'):
+            statements = getattr(node, field, None)
+            if isinstance(statements, list) and statements:
+                setattr(node, field, self._body(statements))
+        for field, value in ast.iter_fields(node):
+            if field in ('body', 'orelse', 'finalbody') and \
+                    isinstance(value, list):
+                continue
+            if isinstance(value, list):
+                setattr(node, field, [self.visit(v) if isinstance(v, ast.AST)
+                                      else v for v in value])
+            elif isinstance(value, ast.AST):
+                setattr(node, field, self.visit(value))
+        return node
+
+    def visit_If(self, node):
+        test = node.test
+        if self._falsy(test):
+            return self._body(node.orelse) if node.orelse else None
+        if isinstance(test, ast.UnaryOp) and isinstance(test.op, ast.Not) \
+                and self._falsy(test.operand):
+            return self._body(node.body)
+        return self.generic_visit(node)
+
+    def visit_Assign(self, node):
+        if all(isinstance(t, ast.Name) and t.id in self.names
+               for t in node.targets):
+            return None
+        return self.generic_visit(node)
+
+    def visit_Try(self, node):
+        node = self.generic_visit(node)
+        if not node.handlers and not node.orelse and \
+                all(isinstance(s, ast.Pass) for s in node.finalbody):
+            return node.body
+        return node
+
+    def visit_Name(self, node):
+        if isinstance(node.ctx, ast.Load) and node.id in self.names:
+            return ast.copy_location(ast.Constant(None), node)
+        return node
+
+    def visit_Attribute(self, node):
+        if isinstance(node.ctx, ast.Load) and self._falsy(node):
+            return ast.copy_location(ast.Constant(None), node)
+        return self.generic_visit(node)
+
+
+def strip_hooks(module):
+    with open(module.__file__) as f:
+        tree = ast.parse(f.read())
+    stripper = _HookStripper()
+    stripper.collect(tree)
+    tree = ast.fix_missing_locations(stripper.visit(tree))
+
+    name = module.__name__ + '_stripped'
+    spec = importlib.util.spec_from_loader(name, loader=None)
+    stripped = importlib.util.module_from_spec(spec)
+    stripped.__package__ = module.__package__
+    sys.modules[name] = stripped
+    exec(compile(tree, module.__file__, 'exec'), stripped.__dict__)
+    return stripped
+
+
+def cases(module):
+    Session, sessionaware = module.Session, module.sessionaware
+
+    @sessionaware
+    def func(session):
+        return session
+
+    def open_close():
+        with Session(nullcontext()):
+            pass
+
+    return Session, [('session open/close', open_close),
+                     ('sessionaware call', func)]
+
+
+def run(stmt, session):
+    with session():
+        return timeit.timeit(stmt, number=NUMBER) / NUMBER
+
+
+def main():
+    stripped_session, stripped = cases(strip_hooks(sessionlib.sessionlib))
+    shipped_session, shipped = cases(sessionlib.sessionlib)
+
+    print('{:<22} {:>12} {:>12} {:>12} {:>14}'.format(
+        'case', 'stripped ns', 'disabled ns', 'enabled ns', 'disabled cost'))
+    for (name, bare), (_, hooked) in zip(stripped, shipped):
+        bare_times, disabled_times = [], []
+        for _ in range(REPEAT):
+            bare_times.append(run(bare, stripped_session))
+            disabled_times.append(run(hooked, shipped_session))
+        bare_time, disabled = min(bare_times), min(disabled_times)
+
+        metrics.enable()
+        try:
+            enabled = min(run(hooked, shipped_session)
+                          for _ in range(REPEAT // 3))
+        finally:
+            metrics.disable()
+
+        print('{:<22} {:>12.0f} {:>12.0f} {:>12.0f} {:>+10.1f} ns'
+              ' {:>+5.1f}%'.format(
+                  name, bare_time * 1e9, disabled * 1e9, enabled * 1e9,
+                  (disabled - bare_time) * 1e9,
+                  (disabled / bare_time - 1) * 100))
+
+
+if __name__ == '__main__':
+    main()
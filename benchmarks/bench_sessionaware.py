@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Per-call overhead of sessionaware dispatch, bound callables and map()."""
+
+import timeit
+
+from collections import deque
+
+from sessionlib import Session, sessionaware
+
+
+NUMBER = 200000
+
+
+def plain(session, value):
+    return value
+
+
+aware = sessionaware(plain)
+
+
+def main():
+    outer = Session()
+    explicit = Session()
+
+    with explicit:
+        with outer:
+            bound = explicit.bind(plain)
+            cases = [
+                ('plain function', lambda: plain(outer, 1)),
+                ('sessionaware, current session', lambda: aware(1)),
+                ('sessionaware, explicit current', lambda: aware(outer, 1)),
+                ('sessionaware, explicit other', lambda: aware(explicit, 1)),
+                ('session.bind', lambda: bound(1)),
+            ]
+
+            # Averaged over a map() of NUMBER items, so it's one "call" each.
+            items = [(1,)] * NUMBER
+            cases.append(('session.starmap, other session',
+                          lambda: deque(explicit.starmap(plain, items),
+                                        maxlen=0)))
+
+            baseline = None
+            print('{:<34} {:>10} {:>10}'.format('case', 'ns/call', 'overhead'))
+            for name, stmt in cases:
+                number = 1 if name.startswith('session.starmap') else NUMBER
+                seconds = min(timeit.repeat(stmt, number=number, repeat=5))
+                per_call = seconds / NUMBER * 1e9
+                if baseline is None:
+                    baseline = per_call
+                print('{:<34} {:>10.0f} {:>10.0f}'.format(
+                    name, per_call, per_call - baseline))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Session stack benchmark: thread isolation and open/close cost by depth."""
+
+import threading
+import time
+
+from sessionlib import Session
+
+
+DEPTHS = (1, 10, 100, 1000)
+THREADS = 8
+ROUNDS = 200
+
+
+def nested_open_close(depth):
+    session = Session()
+    start = time.perf_counter()
+    for _ in range(depth):
+        session.open()
+    for _ in range(depth):
+        session.close()
+    return (time.perf_counter() - start) / (2 * depth)
+
+
+def worker(depth, results, errors):
+    try:
+        for _ in range(ROUNDS):
+            with Session() as outer:
+                nested_open_close(depth)
+                if Session.current() is not outer:
+                    raise AssertionError('session leaked across threads')
+        results.append(min(nested_open_close(depth) for _ in range(ROUNDS)))
+    except Exception as e:
+        errors.append(e)
+
+
+def main():
+    print('{:>6} {:>16} {:>16}'.format('depth', 'single ns/op', 'threaded ns/op'))
+    for depth in DEPTHS:
+        single = min(nested_open_close(depth) for _ in range(ROUNDS))
+
+        results, errors = [], []
+        threads = [threading.Thread(target=worker, args=(depth, results, errors))
+                   for _ in range(THREADS)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if errors:
+            raise errors[0]
+
+        print('{:>6} {:>16.0f} {:>16.0f}'.format(
+            depth, single * 1e9, sum(results) / len(results) * 1e9))
+
+
+if __name__ == '__main__':
+    main()
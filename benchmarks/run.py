@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Run the benchmark suite, optionally saving or checking a baseline.
+
+    python benchmarks/run.py --save benchmarks/baseline.json
+    python benchmarks/run.py --compare benchmarks/baseline.json --threshold 0.25
+
+With --compare the exit status is 1 when any benchmark is slower than its
+baseline by more than the threshold (a fraction: 0.25 means 25%).
+"""
+
+import argparse
+import contextvars
+import json
+import platform
+import sys
+import timeit
+
+from suite import BENCHMARKS
+
+
+def measure(setup, value, repeat):
+    # Every benchmark gets a fresh context, so sessions left open by its
+    # setup don't leak into the next one.
+    context = contextvars.copy_context()
+    fn, ops = context.run(setup, value)
+
+    def run():
+        context.run(fn)
+
+    number, _ = timeit.Timer(run).autorange()
+    best = min(timeit.Timer(run).repeat(repeat=repeat, number=number))
+    return best / number / ops * 1e9
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, ns in results.items():
+        reference = baseline.get(name)
+        if reference is None:
+            status = 'new'
+        else:
+            change = ns / reference - 1
+            status = '{:+.1%}'.format(change)
+            if change > threshold:
+                status += '  REGRESSION'
+                regressions.append(name)
+        print('{:<48} {:>12.1f} ns  {}'.format(name, ns, status))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--save', metavar='PATH',
+                        help='write results to a baseline file')
+    parser.add_argument('--compare', metavar='PATH',
+                        help='compare results against a baseline file')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='allowed slowdown before failing (default 0.25)')
+    parser.add_argument('--filter', default='',
+                        help='only run benchmarks whose name contains this')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args(argv)
+
+    results = {}
+    for name, setup, value in BENCHMARKS:
+        if args.filter in name:
+            results[name] = measure(setup, value, args.repeat)
+            if not args.compare:
+                print('{:<48} {:>12.1f} ns'.format(name, results[name]))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'unit': 'ns/op',
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print('\n{} benchmark(s) regressed by more than {:.0%}'.format(
+                len(regressions), args.threshold))
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
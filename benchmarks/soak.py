@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Concurrency soak test: randomized session traffic, checked for leaks.
+
+    python benchmarks/soak.py --workers 8 --duration 30
+    python benchmarks/soak.py --mode asyncio --workers 50 --duration 30
+
+Workers (threads, or asyncio tasks) loop over randomly chosen operations:
+nested open/close and re-entry, sessionaware calls on an explicit session,
+generators consumed part way and then closed or just dropped, and
+subscribe/unsubscribe churn on long-lived sessions. The first fifth of the
+run warms up; memory traced by tracemalloc at that point is the baseline.
+
+The exit status is 1 when, after the run and a garbage collection:
+
+- traced memory grew beyond --max-growth KiB over the baseline,
+- more than --max-live sessions created by the workers are still alive, or
+  any of them is still open,
+- a worker finished with a session or sessionaware function still current,
+- the long-lived sessions kept subscribers the workers added.
+"""
+
+import argparse
+import asyncio
+import gc
+import random
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
+import weakref
+
+from collections import Counter
+from contextlib import nullcontext
+
+from sessionlib import Session, sessionaware
+from sessionlib.sessionlib import _function_stack
+
+
+class SoakSession(Session):
+    # Every session the workers build, to count the survivors.
+    created = weakref.WeakSet()
+
+    def __init__(self, contexts=0):
+        super().__init__(*[nullcontext(i) for i in range(contexts)])
+        SoakSession.created.add(self)
+
+
+@sessionaware(cls=SoakSession)
+def call(session, depth=0):
+    if depth:
+        return call(depth - 1)
+    return session.current_function
+
+
+@sessionaware(cls=SoakSession)
+def pages(session, count):
+    for i in range(count):
+        yield call(), i
+
+
+@sessionaware(cls=SoakSession)
+async def acall(session, depth=0):
+    if depth:
+        return await acall(depth - 1)
+    await asyncio.sleep(0)
+    return session.current_function
+
+
+@sessionaware(cls=SoakSession)
+async def apages(session, count):
+    for i in range(count):
+        yield await acall(), i
+
+
+class Listener(object):
+    def on_event(self, session):
+        pass
+
+
+# --- Operations. Each returns its name for the throughput report.
+
+def nested(rng, shared):
+    sessions = [SoakSession(rng.randrange(3)) for _ in range(rng.randrange(4))]
+    sessions.append(rng.choice(shared))
+    rng.shuffle(sessions)
+    entered = []
+    try:
+        for session in sessions:
+            # Re-enter some of them.
+            for _ in range(rng.randrange(1, 3)):
+                session.open()
+                entered.append(session)
+            call(rng.randrange(3))
+    finally:
+        for session in reversed(entered):
+            session.close()
+    return 'nested'
+
+
+def explicit(rng, shared):
+    with rng.choice(shared):
+        call(SoakSession(rng.randrange(3)), rng.randrange(3))
+    return 'explicit'
+
+
+def generator(rng, shared):
+    with rng.choice(shared):
+        items = pages(SoakSession(1), rng.randrange(1, 10))
+        for _ in range(rng.randrange(5)):
+            if next(items, None) is None:
+                break
+        if rng.random() < 0.5:
+            items.close()
+    # Otherwise dropped mid-iteration and finalized by the collector.
+    return 'generator'
+
+
+def churn(rng, shared):
+    session = rng.choice(shared)
+    observable = rng.choice((session.on_open, session.on_enter,
+                             session.on_leave, session.on_close))
+    listener = Listener()
+    if rng.random() < 0.5:
+        # Weak subscriptions drop out with their listener.
+        observable.subscribe(listener.on_event, priority=rng.randrange(3),
+                             weak=True)
+    else:
+        subscription = observable.subscribe(listener.on_event)
+        with session:
+            pass
+        subscription.unsubscribe()
+    return 'churn'
+
+
+OPERATIONS = (nested, explicit, generator, churn)
+
+
+async def anested(rng, shared):
+    sessions = [SoakSession(rng.randrange(3)) for _ in range(rng.randrange(4))]
+    sessions.append(rng.choice(shared))
+    rng.shuffle(sessions)
+    entered = []
+    try:
+        for session in sessions:
+            for _ in range(rng.randrange(1, 3)):
+                await session.aopen()
+                entered.append(session)
+            await acall(rng.randrange(3))
+    finally:
+        for session in reversed(entered):
+            await session.aclose()
+    return 'nested'
+
+
+async def aexplicit(rng, shared):
+    async with rng.choice(shared):
+        await acall(SoakSession(rng.randrange(3)), rng.randrange(3))
+    return 'explicit'
+
+
+async def agenerator(rng, shared):
+    async with rng.choice(shared):
+        items = apages(SoakSession(1), rng.randrange(1, 10))
+        try:
+            for _ in range(rng.randrange(5)):
+                await items.__anext__()
+        except StopAsyncIteration:
+            pass
+        if rng.random() < 0.5:
+            await items.aclose()
+    return 'generator'
+
+
+async def achurn(rng, shared):
+    return churn(rng, shared)
+
+
+ASYNC_OPERATIONS = (anested, aexplicit, agenerator, achurn)
+
+
+def _check_worker(errors):
+    if Session.current() is not None:
+        errors.append('worker ended with {} current'.format(Session.current()))
+    if _function_stack.get() is not None:
+        errors.append('worker ended with a sessionaware function current')
+
+
+def run_threads(args, shared, deadline, counts):
+    errors = []
+
+    def worker(seed):
+        rng = random.Random(seed)
+        local = Counter()
+        try:
+            while time.monotonic() < deadline:
+                local[rng.choice(OPERATIONS)(rng, shared)] += 1
+        except Exception:
+            errors.append(traceback.format_exc())
+        _check_worker(errors)
+        with lock:
+            counts.update(local)
+
+    lock = threading.Lock()
+    threads = [threading.Thread(target=worker, args=(args.seed + i,))
+               for i in range(args.workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return errors
+
+
+def run_tasks(args, shared, deadline, counts):
+    errors = []
+
+    async def worker(seed):
+        rng = random.Random(seed)
+        try:
+            while time.monotonic() < deadline:
+                counts[await rng.choice(ASYNC_OPERATIONS)(rng, shared)] += 1
+        except Exception:
+            errors.append(traceback.format_exc())
+        _check_worker(errors)
+
+    async def main():
+        await asyncio.gather(*(worker(args.seed + i)
+                               for i in range(args.workers)))
+
+    asyncio.run(main())
+    return errors
+
+
+def soak(args):
+    run = run_threads if args.mode == 'threads' else run_tasks
+    shared = [SoakSession(2) for _ in range(3)]
+    subscribers = [len(o.subscriptions) for s in shared for o in (
+        s.on_open, s.on_enter, s.on_leave, s.on_close)]
+    SoakSession.created.clear()
+
+    tracemalloc.start(args.frames)
+    start = time.monotonic()
+
+    warmup = Counter()
+    errors = run(args, shared, start + args.duration / 5, warmup)
+    gc.collect()
+    baseline = tracemalloc.take_snapshot()
+    base_size, _ = tracemalloc.get_traced_memory()
+
+    counts = Counter()
+    measured = time.monotonic()
+    errors += run(args, shared, measured + args.duration * 4 / 5, counts)
+    elapsed = time.monotonic() - measured
+
+    gc.collect()
+    size, peak = tracemalloc.get_traced_memory()
+    snapshot = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    total = sum(counts.values())
+    print('{} {} for {:.1f}s: {} ops, {:.0f} ops/s'.format(
+        args.workers, args.mode, elapsed, total, total / elapsed))
+    for name, count in sorted(counts.items()):
+        print('  {:<10} {:>10} ops {:>10.0f} ops/s'.format(
+            name, count, count / elapsed))
+
+    growth = (size - base_size) / 1024
+    live = [s for s in SoakSession.created if s not in shared]
+    opened = [s for s in live if s.opened]
+    print('retained growth {:.1f} KiB (peak {:.1f} KiB), live sessions {}, '
+          'open {}'.format(growth, peak / 1024, len(live), len(opened)))
+
+    if growth > args.max_growth:
+        errors.append('retained memory grew by {:.1f} KiB'.format(growth))
+        for stat in snapshot.compare_to(baseline, 'traceback')[:5]:
+            errors.append('  {}'.format(stat))
+            errors.extend('    {}'.format(l) for l in stat.traceback.format())
+    if len(live) > args.max_live:
+        errors.append('{} sessions still alive'.format(len(live)))
+    if opened or any(s.opened for s in shared):
+        errors.append('sessions left open: {}'.format(len(opened)))
+    if subscribers != [len(o.subscriptions) for s in shared for o in (
+            s.on_open, s.on_enter, s.on_leave, s.on_close)]:
+        errors.append('subscribers left on long-lived sessions')
+
+    for error in errors:
+        print('FAIL', error)
+    return not errors
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--mode', choices=('threads', 'asyncio'),
+                        default='threads')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=10,
+                        help='seconds, including a fifth of warm-up')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-growth', type=float, default=256,
+                        help='retained KiB allowed over the warm-up baseline')
+    parser.add_argument('--max-live', type=int, default=0,
+                        help='worker-created sessions allowed to survive')
+    parser.add_argument('--frames', type=int, default=10,
+                        help='traceback depth traced by tracemalloc')
+    return 0 if soak(parser.parse_args(argv)) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
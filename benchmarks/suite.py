@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+"""Micro-benchmarks for the session lifecycle, sessionaware and Observable.
+
+Each benchmark takes one parameter and returns ``(fn, ops)``: ``fn`` runs
+the measured operation ``ops`` times, so results are reported per op.
+"""
+
+from collections import deque
+from contextlib import nullcontext
+
+from sessionlib import Session, sessionaware
+from sessionlib.utils import Observable
+
+
+BENCHMARKS = []
+
+
+def benchmark(name, param, values):
+    def _register(setup):
+        for value in values:
+            BENCHMARKS.append(('{}[{}={}]'.format(name, param, value),
+                               setup, value))
+        return setup
+    return _register
+
+
+def _consume(iterable):
+    deque(iterable, maxlen=0)
+
+
+@benchmark('session.open_close', 'contexts', (0, 1, 5, 20))
+def open_close(contexts):
+    contexts = [nullcontext() for _ in range(contexts)]
+
+    def fn():
+        with Session(*contexts):
+            pass
+
+    return fn, 1
+
+
+@benchmark('session.reentry', 'depth', (1, 10, 100, 1000))
+def reentry(depth):
+    session = Session()
+
+    def fn():
+        for _ in range(depth):
+            session.open()
+        for _ in range(depth):
+            session.close()
+
+    return fn, depth
+
+
+@benchmark('session.fork', 'contexts', (0, 1, 5, 20))
+def fork(contexts):
+    # Same parents as session.open_close: a fork's cost shouldn't grow with
+    # the contexts its parent entered.
+    parent = Session(*[nullcontext() for _ in range(contexts)]).open()
+
+    def fn():
+        with parent.fork():
+            pass
+
+    return fn, 1
+
+
+@benchmark('sessionaware.call', 'mode', ('current', 'explicit', 'other',
+                                         'bound'))
+def sessionaware_call(mode):
+    @sessionaware
+    def func(session):
+        return session
+
+    current = Session().open()
+    other = Session()
+    calls = {
+        'current': lambda: func(),
+        'explicit': lambda: func(current),
+        'other': lambda: func(other),
+        'bound': current.bind(func),
+    }
+    call = calls[mode]
+
+    def fn():
+        for _ in range(1000):
+            call()
+
+    return fn, 1000
+
+
+@benchmark('sessionaware.generator', 'items', (1, 1000, 1000000))
+def sessionaware_generator(items):
+    @sessionaware
+    def func(session):
+        yield from range(items)
+
+    Session().open()
+
+    def fn():
+        _consume(func())
+
+    return fn, items
+
+
+@benchmark('observable.call', 'subscribers', (0, 1, 10, 100))
+def observable_call(subscribers):
+    observable = Observable(object())
+    for _ in range(subscribers):
+        observable.subscribe(lambda obj: None)
+
+    def fn():
+        for _ in range(1000):
+            observable()
+
+    return fn, 1000
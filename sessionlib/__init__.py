@@ -2,7 +2,18 @@
 
 """Top-level package for sessionlib."""
 
-from .sessionlib import Session, sessionaware, SessionlessError
+from .sessionlib import (Session, sessionaware, lazycontext, parallel,
+                         retrying, SessionlessError, DeadlineExceeded)
+from .admission import Admission, AdmissionError, admission_priority
+from .buffer import WriteBuffer, FlushError
+from .cache import session_cached
+from .executor import (SessionExecutor, SessionProcessPoolExecutor,
+                       init_worker_session)
+from . import metrics
+from .profiler import Profiler
+from .pool import SessionPool, PoolTimeoutError, PoolClosedError
+from .shared import SharedResources, shared_resources
+from .teardown import TeardownWorker, drain_teardowns
 
 __author__ = """Paulo Romeira"""
 __email__ = 'paulo@pauloromeira.com'
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import heapq
+import threading
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from itertools import count
+from time import monotonic
+
+from .metrics import Histogram
+
+# Lane of the opens made in this context (see admission_priority()).
+_priority = ContextVar('sessionlib_admission_priority', default=0)
+
+
+class AdmissionError(RuntimeError):
+    pass
+
+
+@contextmanager
+def admission_priority(priority):
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class _Waiter(object):
+    __slots__ = ('priority', 'event', 'loop', 'future', 'admitted')
+
+    def __init__(self, priority, loop=None):
+        self.priority = priority
+        self.loop = loop
+        self.admitted = False
+        if loop is None:
+            self.event = threading.Event()
+            self.future = None
+        else:
+            self.event = None
+            self.future = loop.create_future()
+
+    def wake(self):
+        if self.loop is None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(self._resolve)
+
+    def _resolve(self):
+        if not self.future.done():
+            self.future.set_result(None)
+
+
+# Caps the sessions of a class (and its subclasses) open at once; re-entries
+# don't count. Set it as a class attribute:
+#
+#     class DBSession(Session):
+#         admission = Admission(20, timeout=2)
+#
+# Opens over the limit queue until an open session closes, highest priority
+# lane first (see admission_priority()), FIFO within a lane, and fail with
+# AdmissionError after timeout (capped by the session's deadline), when
+# max_queue callers are already waiting, or right away with timeout=0. aopen()
+# waits without blocking the event loop. A slot is freed once the session's
+# contexts have exited.
+class Admission(object):
+    def __init__(self, limit, timeout=None, max_queue=None):
+        if limit < 1:
+            raise ValueError('limit must be at least 1')
+        self.limit = limit
+        self.timeout = timeout
+        self.max_queue = max_queue
+
+        self._active = 0
+        self._queue = []
+        self._order = count()
+        self._lock = threading.Lock()
+
+        self._admitted = self._rejected = self._timeouts = 0
+        self._waits = Histogram()
+
+
+    @property
+    def stats(self):
+        with self._lock:
+            lanes = {}
+            for _, _, waiter in self._queue:
+                lanes[waiter.priority] = lanes.get(waiter.priority, 0) + 1
+            return {
+                'limit': self.limit,
+                'active': self._active,
+                'queued': len(self._queue),
+                'lanes': lanes,
+                'admitted': self._admitted,
+                'rejected': self._rejected,
+                'timeouts': self._timeouts,
+                'wait': self._waits.as_dict(),
+            }
+
+
+    def _timeout(self, remaining):
+        if remaining is None:
+            return self.timeout
+        if self.timeout is None:
+            return remaining
+        return min(self.timeout, remaining)
+
+    def _admit(self, timeout, loop=None):
+        with self._lock:
+            if self._active < self.limit and not self._queue:
+                self._active += 1
+                self._admitted += 1
+                return None
+            if timeout == 0 or (self.max_queue is not None and
+                                len(self._queue) >= self.max_queue):
+                self._rejected += 1
+                raise AdmissionError('{} sessions already open'.format(
+                    self.limit))
+
+            waiter = _Waiter(_priority.get(), loop)
+            heapq.heappush(self._queue,
+                           (-waiter.priority, next(self._order), waiter))
+            return waiter
+
+    # True if the waiter gave up its place, False if it was admitted anyway.
+    def _abandon(self, waiter, start):
+        with self._lock:
+            self._waits.record(monotonic() - start)
+            if waiter.admitted:
+                return False
+            self._queue = [e for e in self._queue if e[2] is not waiter]
+            heapq.heapify(self._queue)
+            return True
+
+    def acquire(self, remaining=None):
+        timeout = self._timeout(remaining)
+        waiter = self._admit(timeout)
+        if waiter is None:
+            return
+
+        start = monotonic()
+        waiter.event.wait(timeout)
+        if self._abandon(waiter, start):
+            with self._lock:
+                self._timeouts += 1
+            raise AdmissionError('Timed out waiting for one of {} sessions'
+                                 .format(self.limit))
+
+    async def aacquire(self, remaining=None):
+        timeout = self._timeout(remaining)
+        waiter = self._admit(timeout, asyncio.get_running_loop())
+        if waiter is None:
+            return
+
+        start = monotonic()
+        try:
+            await asyncio.wait_for(waiter.future, timeout)
+        except asyncio.TimeoutError:
+            pass
+        except BaseException:
+            # Cancelled: hand back a slot granted in the meantime.
+            if not self._abandon(waiter, start):
+                self.release()
+            raise
+        if self._abandon(waiter, start):
+            with self._lock:
+                self._timeouts += 1
+            raise AdmissionError('Timed out waiting for one of {} sessions'
+                                 .format(self.limit))
+
+    def release(self):
+        with self._lock:
+            # The slot goes straight to the next waiter.
+            while self._queue:
+                _, _, waiter = heapq.heappop(self._queue)
+                try:
+                    waiter.wake()
+                except RuntimeError:
+                    # Its event loop is gone.
+                    continue
+                waiter.admitted = True
+                self._admitted += 1
+                return
+            self._active -= 1
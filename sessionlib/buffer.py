@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+import time
+
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class FlushError(RuntimeError):
+    def __init__(self, errors):
+        super().__init__('{} target(s) failed to flush'.format(len(errors)))
+        self.errors = errors
+
+
+# Deferred operations, coalesced per (target, key) and flushed in bulk: each
+# target's operations go as one list to the flusher registered for it, and
+# targets without one have their operations called in order. on_error is
+# 'raise' (flush the other targets, then raise FlushError), 'log', or a
+# callable (target, ops, exc).
+class WriteBuffer(object):
+    def __init__(self, max_size=None, max_age=None, on_error='raise',
+                 discard_on_error=True):
+        self.max_size = max_size
+        self.max_age = max_age
+        self.on_error = on_error
+        self.discard_on_error = discard_on_error
+        self.flushers = {}
+        self.flushes = 0
+        self._ops = OrderedDict()
+        self._oldest = None
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._ops)
+
+    def register(self, target, flusher):
+        self.flushers[target] = flusher
+
+    def defer(self, key, op, target=None):
+        with self._lock:
+            if not self._ops:
+                self._oldest = time.monotonic()
+            self._ops.pop((target, key), None)
+            self._ops[target, key] = op
+
+            if self.max_size is not None and len(self._ops) >= self.max_size:
+                self.flush()
+            elif self.max_age is not None and \
+                    time.monotonic() - self._oldest >= self.max_age:
+                self.flush()
+
+    def discard(self):
+        with self._lock:
+            self._ops.clear()
+            self._oldest = None
+
+    def flush(self):
+        with self._lock:
+            ops, self._ops = self._ops, OrderedDict()
+            self._oldest = None
+            if not ops:
+                return
+            self.flushes += 1
+
+            groups = OrderedDict()
+            for (target, _), op in ops.items():
+                groups.setdefault(target, []).append(op)
+
+            errors = []
+            for target, group in groups.items():
+                try:
+                    flusher = self.flushers.get(target)
+                    if flusher is not None:
+                        flusher(group)
+                    else:
+                        for op in group:
+                            op()
+                except Exception as e:
+                    if self.on_error == 'raise':
+                        errors.append((target, e))
+                    elif self.on_error == 'log':
+                        logger.exception('Error flushing %r', target)
+                    else:
+                        self.on_error(target, group, e)
+
+            if errors:
+                raise FlushError(errors)
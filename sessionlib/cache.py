@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+from collections import OrderedDict
+from functools import wraps
+from inspect import (isgeneratorfunction, iscoroutinefunction,
+                     isasyncgenfunction)
+from types import GeneratorType
+
+from .sessionlib import Session, SessionlessError, sessionaware
+
+
+_KWARGS_MARK = object()
+
+
+def _make_key(args, kwargs):
+    if kwargs:
+        return args + (_KWARGS_MARK,) + tuple(sorted(kwargs.items()))
+    return args
+
+
+class SessionCache(object):
+    def __init__(self, maxsize=128, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value, expires = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return False, None
+            if expires is not None and expires <= time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return False, None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return True, value
+
+    def put(self, key, value):
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            self._data[key] = value, expires
+            self._data.move_to_end(key)
+            if self.maxsize is not None and len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            return self._data.pop(key, None) is not None
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def info(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self._data), 'maxsize': self.maxsize}
+
+
+def session_cached(function=None, cls=Session, maxsize=128, ttl=None,
+                   materialize=False):
+    def _decorate(func):
+        if iscoroutinefunction(func) or isasyncgenfunction(func):
+            raise TypeError('session_cached does not support async functions')
+        if isgeneratorfunction(func) and not materialize:
+            raise TypeError('{} is a generator function; pass '
+                            'materialize=True to cache its items'.format(
+                                func.__qualname__))
+
+        totals = {'hits': 0, 'misses': 0}
+
+        def _cache(session, create=True):
+            caches = session._caches
+            if caches is None:
+                if not create:
+                    return None
+                caches = session._caches = {}
+            try:
+                return caches[wrapped]
+            except KeyError:
+                if not create:
+                    return None
+                return caches.setdefault(wrapped, SessionCache(maxsize, ttl))
+
+        @wraps(func)
+        def cached(session, *args, **kwargs):
+            cache = _cache(session)
+            key = _make_key(args, kwargs)
+
+            hit, value = cache.get(key)
+            if hit:
+                totals['hits'] += 1
+                return value
+            totals['misses'] += 1
+
+            value = func(session, *args, **kwargs)
+            if isinstance(value, GeneratorType):
+                if not materialize:
+                    raise TypeError('{} returned a generator; pass '
+                                    'materialize=True to cache its '
+                                    'items'.format(func.__qualname__))
+                value = tuple(value)
+
+            cache.put(key, value)
+            return value
+
+        wrapped = sessionaware(cached, cls=cls)
+
+        def _resolve(args):
+            if args and isinstance(args[0], cls):
+                return args[0], args[1:]
+            session = cls.current()
+            if session is None:
+                raise SessionlessError('No session is currently active')
+            return session, args
+
+        def invalidate(*args, **kwargs):
+            session, args = _resolve(args)
+            cache = _cache(session, create=False)
+            return cache is not None and \
+                cache.invalidate(_make_key(args, kwargs))
+
+        def cache_clear(session=None):
+            session, _ = _resolve((session,) if session else ())
+            cache = _cache(session, create=False)
+            if cache is not None:
+                cache.clear()
+
+        def cache_info(session=None):
+            if session is None:
+                return dict(totals)
+            cache = _cache(session, create=False)
+            return cache.info() if cache is not None else \
+                SessionCache(maxsize).info()
+
+        wrapped.invalidate = invalidate
+        wrapped.cache_clear = cache_clear
+        wrapped.cache_info = cache_info
+        return wrapped
+
+    return _decorate(function) if function else _decorate
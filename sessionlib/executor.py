@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from contextvars import copy_context
+from multiprocessing.util import Finalize
+
+from .sessionlib import Session, SessionlessError
+
+
+# Tasks run in a copy of the submitter's context: they see its session (and
+# calling sessionaware function) but keep their own function stack. The session
+# is pinned until each task finishes, so its final close() waits for them.
+class SessionExecutor(ThreadPoolExecutor):
+    def __init__(self, max_workers=None, session=None, **kwargs):
+        super().__init__(max_workers, **kwargs)
+        self.session = session
+
+    def submit(self, fn, *args, **kwargs):
+        session = self.session or Session.current()
+        if session is None or not session.opened:
+            raise SessionlessError('No session is currently active')
+
+        context = copy_context()
+        if Session.current() is not session:
+            context.run(Session._push, session)
+
+        session._pin()
+        try:
+            future = super().submit(context.run, fn, *args, **kwargs)
+        except BaseException:
+            session._unpin()
+            raise
+        future.add_done_callback(lambda _: session._unpin())
+        return future
+
+
+_worker_session = None
+
+
+# Process pool initializer: opens a session from its recipe and leaves it
+# current for every task the worker runs, closing it when the worker exits.
+def init_worker_session(recipe, initializer=None, initargs=()):
+    global _worker_session
+    _worker_session = Session.from_recipe(recipe).open()
+    # Pool workers skip atexit handlers but run multiprocessing finalizers.
+    Finalize(_worker_session, _worker_session.close, exitpriority=10)
+
+    if initializer is not None:
+        initializer(*initargs)
+
+
+class SessionProcessPoolExecutor(ProcessPoolExecutor):
+    def __init__(self, max_workers=None, session=None, initializer=None,
+                 initargs=(), **kwargs):
+        session = session or Session.current()
+        if session is None:
+            raise SessionlessError('No session is currently active')
+
+        self.recipe = session.recipe()
+        super().__init__(max_workers, initializer=init_worker_session,
+                         initargs=(self.recipe, initializer, initargs),
+                         **kwargs)
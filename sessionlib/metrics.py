@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+
+"""Opt-in lifecycle and sessionaware timings.
+
+Nothing is recorded until :func:`enable` is called; while disabled the only
+cost on the hot paths is a check of :data:`recorder` against ``None``.
+"""
+
+import threading
+
+from bisect import bisect_left
+from time import perf_counter
+
+
+# Upper bounds, in seconds, of the histogram buckets (1-2-5 steps from 1us to
+# 10s). Samples above the last bound go to an overflow bucket.
+BUCKETS = tuple(m * 10 ** e for e in range(-6, 1) for m in (1, 2, 5)) + (10,)
+
+recorder = None
+
+
+def _name(obj):
+    return '{}.{}'.format(getattr(obj, '__module__', None) or '?',
+                          getattr(obj, '__qualname__', None) or repr(obj))
+
+
+def context_name(context):
+    # contextmanager()-based contexts are named after their function.
+    func = getattr(context, 'func', None)
+    if func is not None and hasattr(func, '__qualname__'):
+        return _name(func)
+    return _name(type(context))
+
+
+class ContextTimer(object):
+    def __init__(self, recorder, session, context):
+        self.recorder = recorder
+        self.session = session
+        self.name = context_name(context)
+        self.start = perf_counter()
+        self.exit_start = None
+
+    def entered(self):
+        self.recorder.record_context(self.session, self.name, 'enter',
+                                     perf_counter() - self.start)
+
+    def exiting(self):
+        self.exit_start = perf_counter()
+
+    def exited(self):
+        if self.exit_start is not None:
+            self.recorder.record_context(self.session, self.name, 'exit',
+                                         perf_counter() - self.exit_start)
+
+
+class Histogram(object):
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def percentile(self, q):
+        # Upper bound of the bucket holding the q-th sample.
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'min': self.min,
+            'max': self.max,
+            'mean': self.mean,
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99),
+            'buckets': dict(zip(BUCKETS + (float('inf'),), self.counts)),
+        }
+
+
+class SessionStats(object):
+    def __init__(self):
+        self.open = Histogram()
+        self.close = Histogram()
+        self.held = Histogram()
+        self.reentries = 0
+        self.retries = 0
+        self.rollbacks = 0
+        self.contexts = {}
+
+    def context(self, name):
+        try:
+            return self.contexts[name]
+        except KeyError:
+            return self.contexts.setdefault(
+                name, {'enter': Histogram(), 'exit': Histogram()})
+
+    def as_dict(self):
+        return {
+            'open': self.open.as_dict(),
+            'close': self.close.as_dict(),
+            'held': self.held.as_dict(),
+            'reentries': self.reentries,
+            'retries': self.retries,
+            'rollbacks': self.rollbacks,
+            'contexts': {name: {k: h.as_dict() for k, h in hists.items()}
+                         for name, hists in self.contexts.items()},
+        }
+
+
+class Recorder(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.sessions = {}
+        self.functions = {}
+
+    def _session(self, cls):
+        try:
+            return self.sessions[cls]
+        except KeyError:
+            return self.sessions.setdefault(cls, SessionStats())
+
+    def record_open(self, session, elapsed):
+        with self._lock:
+            self._session(type(session)).open.record(elapsed)
+
+    def record_close(self, session, elapsed, held):
+        with self._lock:
+            stats = self._session(type(session))
+            stats.close.record(elapsed)
+            if held is not None:
+                stats.held.record(held)
+
+    def record_reentry(self, session):
+        with self._lock:
+            self._session(type(session)).reentries += 1
+
+    def record_retry(self, session):
+        with self._lock:
+            self._session(type(session)).retries += 1
+
+    def record_rollback(self, session):
+        with self._lock:
+            self._session(type(session)).rollbacks += 1
+
+    def record_context(self, session, name, phase, elapsed):
+        with self._lock:
+            self._session(type(session)).context(name)[phase].record(elapsed)
+
+    def record_function(self, func, elapsed):
+        with self._lock:
+            try:
+                histogram = self.functions[func]
+            except KeyError:
+                histogram = self.functions[func] = Histogram()
+            histogram.record(elapsed)
+
+    def snapshot(self, cls=None):
+        with self._lock:
+            if cls is not None:
+                stats = self.sessions.get(cls)
+                return stats.as_dict() if stats else SessionStats().as_dict()
+            return {
+                'sessions': {_name(c): s.as_dict()
+                             for c, s in self.sessions.items()},
+                'functions': {_name(f): h.as_dict()
+                              for f, h in self.functions.items()},
+            }
+
+
+def enable():
+    global recorder
+    if recorder is None:
+        recorder = Recorder()
+    return recorder
+
+
+def disable():
+    global recorder
+    recorder = None
+
+
+def snapshot(cls=None):
+    return recorder.snapshot(cls) if recorder is not None else None
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+import time
+
+from collections import deque
+from contextlib import contextmanager
+from contextvars import Context
+
+logger = logging.getLogger(__name__)
+
+_OBSERVABLES = ('on_open', 'on_enter', 'on_leave', 'on_close')
+
+
+class PoolTimeoutError(RuntimeError):
+    pass
+
+
+class PoolClosedError(RuntimeError):
+    pass
+
+
+class _PoolEntry(object):
+    def __init__(self, session):
+        self.session = session
+        # Pooled sessions are opened in a private context so they never show
+        # up as current in the thread that happened to warm them up.
+        self.context = Context()
+        self.context.run(session.open)
+        self.created = self.last_used = time.monotonic()
+        self.subscriptions = {name: set(getattr(session, name).subscriptions)
+                              for name in _OBSERVABLES}
+
+    def reset(self):
+        for name, subscriptions in self.subscriptions.items():
+            for subscription in getattr(self.session, name).subscriptions:
+                if subscription not in subscriptions:
+                    subscription.unsubscribe()
+        self.session._caches = self.session._deadline = None
+        self.last_used = time.monotonic()
+
+    # A pooled session's timeout budgets each checkout, not its lifetime.
+    def checkout(self):
+        self.context.run(self.session._start_deadline)
+
+    def close(self):
+        self.context.run(self.session.close)
+
+
+class SessionPool(object):
+    def __init__(self, factory, min_size=0, max_size=10, idle_timeout=None,
+                 max_lifetime=None, health_check=None):
+        if not 0 <= min_size <= max_size:
+            raise ValueError('Expected 0 <= min_size <= max_size')
+
+        self.factory = factory
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.health_check = health_check
+
+        self._idle = deque()
+        self._in_use = {}
+        self._size = 0
+        self._closed = False
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+
+        self._hits = self._misses = self._waits = self._timeouts = 0
+        self._created = self._discarded = 0
+        self._wait_time = 0.0
+
+        self.prewarm()
+
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': len(self._in_use),
+                'hits': self._hits,
+                'misses': self._misses,
+                'waits': self._waits,
+                'wait_time': self._wait_time,
+                'timeouts': self._timeouts,
+                'created': self._created,
+                'discarded': self._discarded,
+            }
+
+
+    def _expired(self, entry, now):
+        if self.max_lifetime is not None and \
+                now - entry.created >= self.max_lifetime:
+            return True
+        if self.idle_timeout is not None and \
+                now - entry.last_used >= self.idle_timeout:
+            return True
+        return False
+
+    # A health check that raises counts as failed, so the entry is discarded
+    # rather than lost with its slot.
+    def _healthy(self, entry):
+        if self.health_check is None:
+            return True
+        try:
+            return self.health_check(entry.session)
+        except Exception:
+            logger.exception('Health check of pooled %s failed',
+                             entry.session)
+            return False
+
+    def _create(self):
+        try:
+            entry = _PoolEntry(self.factory())
+        except BaseException:
+            with self._lock:
+                self._size -= 1
+                self._available.notify()
+            raise
+        with self._lock:
+            self._created += 1
+        return entry
+
+    def _discard(self, entry):
+        with self._lock:
+            self._size -= 1
+            self._discarded += 1
+            self._available.notify()
+        try:
+            entry.close()
+        except Exception:
+            logger.exception('Error closing pooled %s', entry.session)
+
+
+    # Slots are reserved one create at a time, so a failing factory gives
+    # back the only one it took.
+    def prewarm(self):
+        while True:
+            with self._lock:
+                if self._size >= self.min_size:
+                    return
+                self._size += 1
+
+            entry = self._create()
+            with self._lock:
+                self._idle.append(entry)
+                self._available.notify()
+
+    def evict(self):
+        now = time.monotonic()
+        with self._lock:
+            expired = [e for e in self._idle if self._expired(e, now)]
+            for entry in expired:
+                self._idle.remove(entry)
+
+        for entry in expired:
+            self._discard(entry)
+
+        if not self._closed:
+            self.prewarm()
+
+        return len(expired)
+
+
+    def acquire(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        waited = False
+        start = time.monotonic()
+
+        while True:
+            with self._lock:
+                while True:
+                    if self._closed:
+                        raise PoolClosedError('{} is closed'.format(self))
+                    if self._idle:
+                        entry = self._idle.pop()
+                        hit = True
+                        break
+                    if self._size < self.max_size:
+                        self._size += 1
+                        entry = None
+                        hit = False
+                        break
+
+                    waited = True
+                    remaining = None if deadline is None \
+                        else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        self._timeouts += 1
+                        self._waits += 1
+                        self._wait_time += time.monotonic() - start
+                        raise PoolTimeoutError(
+                            'No session available in {}'.format(self))
+                    self._available.wait(remaining)
+
+            if entry is None:
+                entry = self._create()
+            elif self._expired(entry, time.monotonic()) or \
+                    not self._healthy(entry):
+                self._discard(entry)
+                continue
+
+            with self._lock:
+                if hit:
+                    self._hits += 1
+                else:
+                    self._misses += 1
+                if waited:
+                    self._waits += 1
+                    self._wait_time += time.monotonic() - start
+                self._in_use[entry.session] = entry
+
+            entry.checkout()
+            return entry.session
+
+    def release(self, session):
+        with self._lock:
+            entry = self._in_use.pop(session)
+
+        # A session still entered by its user can't be handed out again.
+        if self._closed or session.depth != 1 or \
+                self._expired(entry, time.monotonic()):
+            self._discard(entry)
+            return
+
+        # A checkout is the buffer's unit of work (pool.session() has already
+        # flushed or discarded it).
+        try:
+            session.flush()
+        except BaseException:
+            self._discard(entry)
+            raise
+
+        entry.reset()
+        with self._lock:
+            self._idle.append(entry)
+            self._available.notify()
+
+    @contextmanager
+    def session(self, timeout=None):
+        session = self.acquire(timeout)
+        try:
+            with session:
+                try:
+                    yield session
+                except BaseException:
+                    # A checkout is the session's unit of work.
+                    if session._buffer is not None and \
+                            session._buffer.discard_on_error:
+                        session._buffer.discard()
+                    raise
+                session.flush()
+        finally:
+            self.release(session)
+
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, deque()
+            self._available.notify_all()
+
+        for entry in idle:
+            self._discard(entry)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
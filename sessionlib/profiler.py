@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import threading
+
+from collections import Counter
+from time import perf_counter
+
+from .metrics import _name
+from .sessionlib import _frame_codes
+
+
+# Samples the sessionaware function stack of every thread at a fixed interval
+# and counts identical stacks, for flame graphs:
+#
+#     with Profiler(interval=0.001) as profiler:
+#         serve()
+#     profiler.write('app.folded')  # flamegraph.pl app.folded > app.svg
+#
+# Stacks are read from the threads' Python frames, since context variables of
+# other threads can't be: a function is on the stack while its body runs, so
+# generators count only while they're being advanced, as with current_function.
+# A session's class opens each run of frames called under it. Nothing is done
+# on the sessionaware paths, so stopped profilers cost nothing.
+class Profiler(object):
+    def __init__(self, interval=0.001, threads=True):
+        if interval <= 0:
+            raise ValueError('interval must be positive')
+        self.interval = interval
+        self.threads = threads
+        self.samples = Counter()
+        self.sample_count = 0
+        self.sample_time = 0.0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        if self._thread is not None:
+            raise RuntimeError('{} is already running'.format(self))
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='sessionlib-profiler')
+        self._thread.start()
+        return self
+
+    def stop(self):
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            self._stop.set()
+            thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+
+    def sample(self):
+        start = perf_counter()
+        own = threading.get_ident()
+        names = {t.ident: t.name for t in threading.enumerate()} \
+            if self.threads else None
+        stacks = []
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            stack = _function_stack(frame)
+            if stack:
+                if names is not None:
+                    stack = (names.get(ident, str(ident)),) + stack
+                stacks.append(stack)
+
+        with self._lock:
+            self.samples.update(stacks)
+            self.sample_count += 1
+            self.sample_time += perf_counter() - start
+
+    def clear(self):
+        with self._lock:
+            self.samples.clear()
+            self.sample_count = 0
+            self.sample_time = 0.0
+
+
+    def collapsed(self):
+        with self._lock:
+            samples = list(self.samples.items())
+        lines = Counter()
+        for stack, count in samples:
+            lines[';'.join(map(_label, stack))] += count
+        return ''.join('{} {}\n'.format(line, count)
+                       for line, count in sorted(lines.items()))
+
+    def write(self, file):
+        if isinstance(file, str):
+            with open(file, 'w') as f:
+                f.write(self.collapsed())
+        else:
+            file.write(self.collapsed())
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {
+                'samples': self.sample_count,
+                'stacks': sum(self.samples.values()),
+                'sample_time': self.sample_time,
+                'mean_sample_time': self.sample_time / self.sample_count
+                if self.sample_count else None,
+            }
+
+
+# Raw stacks of session classes and functions, named only for output.
+def _function_stack(frame):
+    calls = []
+    while frame is not None:
+        if frame.f_code in _frame_codes:
+            f_locals = frame.f_locals
+            calls.append((f_locals.get('session'), f_locals.get('func')))
+        frame = frame.f_back
+
+    stack = []
+    session = None
+    for call_session, func in reversed(calls):
+        if call_session is not session:
+            session = call_session
+            stack.append(type(session))
+        stack.append(func)
+    return tuple(stack)
+
+
+def _label(item):
+    if isinstance(item, str):
+        return item
+    if isinstance(item, type):
+        return item.__qualname__
+    return _name(item)
@@ -1,172 +1,1519 @@
 # -*- coding: utf-8 -*-
 
+import asyncio
 import logging
+import random
+import sys
+import threading
 
-from types import GeneratorType
-from functools import wraps
-from contextlib import ExitStack
+from collections import deque
+
+from types import GeneratorType, AsyncGeneratorType
+from functools import wraps, lru_cache
+from itertools import islice
+from inspect import (iscoroutinefunction, isgeneratorfunction,
+                     isasyncgenfunction)
+from contextlib import ExitStack, AsyncExitStack
+from contextvars import ContextVar, copy_context
+from concurrent.futures import Future, ThreadPoolExecutor
+from time import perf_counter, monotonic, sleep
+from . import metrics as _metrics
+from .buffer import WriteBuffer
+from .teardown import TeardownWorker, default_worker
 from .utils import Observable
 
 logger = logging.getLogger(__name__)
 
+# The active session stack is a linked list of (session, parent) nodes held in
+# a context variable, so each thread and asyncio task sees its own stack and
+# push/pop never copy it.
+_session_stack = ContextVar('sessionlib_session_stack', default=None)
+
+# Same for the sessionaware call path: (session, function, parent) nodes, so
+# concurrent tasks sharing a session keep their own current_function.
+_function_stack = ContextVar('sessionlib_function_stack', default=None)
+
+# Code objects of the sessionaware frames that run a function on behalf of a
+# session (each has `session` and `func` locals), so a sampling profiler can
+# rebuild the function stacks of other threads from their Python frames.
+_frame_codes = set()
+
+# Deadline already enforced through asyncio cancellation in this task, so
+# nested sessionaware coroutines don't wrap themselves again.
+_enforced_deadline = ContextVar('sessionlib_enforced_deadline', default=None)
+
+# Marks lazy contexts that aren't materialized yet.
+_MISSING = object()
+
 
 class SessionlessError(RuntimeError):
     pass
 
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
 class Session(object):
-    _sessions = []
+    # Subclasses that don't declare __slots__ get a __dict__ as usual.
+    __slots__ = ('timeout', '_deadline', '_contexts', '_depth', '_pins',
+                 '_forks', '_lock', '_changed', '_opening',
+                 '_opened_at', '_caches', '_closing', '_parent',
+                 '_exit_stack', '_deferred', '_materialized', '_lazy_lock',
+                 '_buffer', '_on_open', '_on_enter',
+                 '_on_leave', '_on_close', '__weakref__')
+
+    # An Admission capping how many sessions of this class are open at once.
+    admission = None
+
+    # State is initialized here, so subclasses overriding __init__ without
+    # calling it still get a usable session.
+    def __new__(cls, *args, **kwargs):
+        self = object.__new__(cls)
+        self.timeout = self._deadline = None
+        self._contexts = ()
+        self._depth = self._pins = self._forks = 0
+        # Sessions can be entered and pinned from several threads (see
+        # executor.py), so their state is updated under their own lock. The
+        # condition on it, made once someone has to wait, wakes closers
+        # waiting for pinned tasks and entries waiting for an open to finish.
+        self._lock = threading.Lock()
+        self._changed = None
+        self._opening = False
+        self._opened_at = self._caches = self._exit_stack = None
+        self._closing = self._parent = self._deferred = None
+        self._materialized = self._lazy_lock = None
+        self._buffer = None
+        self._on_open = self._on_enter = None
+        self._on_leave = self._on_close = None
+        return self
 
 
     @classmethod
     def current(cls):
-        return cls._sessions[-1] if cls._sessions else None
+        node = _session_stack.get()
+        return node[0] if node else None
 
     @classmethod
     def _push(cls, session):
-        cls._sessions.append(session)
+        _session_stack.set((session, _session_stack.get()))
 
     @classmethod
     def _pop(cls):
-        cls._sessions.pop()
+        _session_stack.set(_session_stack.get()[1])
+
+    # Sessions are left in reverse order, except one closed from under a
+    # session still open above it (like a fork it leaked), which takes out
+    # its own entry and leaves those above in place.
+    def _leave_stack(self):
+        node = _session_stack.get()
+        if node is None or node[0] is self:
+            self.__class__._pop()
+            return
+        above = []
+        while node is not None and node[0] is not self:
+            above.append(node[0])
+            node = node[1]
+        if node is None:
+            self.__class__._pop()
+            return
+        node = node[1]
+        for session in reversed(above):
+            node = (session, node)
+        _session_stack.set(node)
 
 
-    def __init__(self, *contextmanagers):
+    def __init__(self, *contextmanagers, timeout=None):
         self._contexts = contextmanagers
+        self.timeout = timeout
+
+
+    # The deadline is fixed when the session is opened: its own timeout,
+    # capped by the deadline of the session it was opened in.
+    def _start_deadline(self):
+        deadline = None if self.timeout is None else monotonic() + self.timeout
+        node = _session_stack.get()[1]
+        for parent in (node and node[0], self._parent):
+            if parent is not None and parent._deadline is not None:
+                if deadline is None or parent._deadline < deadline:
+                    deadline = parent._deadline
+        self._deadline = deadline
+
+    @property
+    def deadline(self):
+        return self._deadline
+
+    def remaining(self):
+        if self._deadline is None:
+            return None
+        return max(self._deadline - monotonic(), 0.0)
+
+    def check_deadline(self):
+        if self._deadline is not None and monotonic() >= self._deadline:
+            raise DeadlineExceeded('{} ran out of time'.format(self))
 
 
     def _push_function(self, func):
-        self._function_stack = getattr(self, '_function_stack', [])
-        self._function_stack.append(func)
+        _function_stack.set((self, func, _function_stack.get()))
 
     def _pop_function(self):
-        self._function_stack = getattr(self, '_function_stack', [])
-        self._function_stack.pop()
+        _function_stack.set(_function_stack.get()[2])
 
     @property
     def current_function(self):
-        self._function_stack = getattr(self, '_function_stack', [])
-        return self._function_stack[-1] if self._function_stack else None
+        node = _function_stack.get()
+        while node:
+            if node[0] is self:
+                return node[1]
+            node = node[2]
+        return None
 
     @property
     def on_open(self):
-        self._on_open = getattr(self, '_on_open', Observable(self))
+        if self._on_open is None:
+            self._on_open = Observable(self)
         return self._on_open
 
     @property
     def on_enter(self):
-        self._on_enter = getattr(self, '_on_enter', Observable(self))
+        if self._on_enter is None:
+            self._on_enter = Observable(self)
         return self._on_enter
 
     @property
     def on_leave(self):
-        self._on_leave = getattr(self, '_on_leave', Observable(self))
+        if self._on_leave is None:
+            self._on_leave = Observable(self)
         return self._on_leave
 
     @property
     def on_close(self):
-        self._on_close = getattr(self, '_on_close', Observable(self))
+        if self._on_close is None:
+            self._on_close = Observable(self)
         return self._on_close
 
     def enter_contexts(self):
-        yield from self._contexts
+        for context in self._contexts:
+            yield context
+
+
+    # Deferred writes. Subclasses override write_buffer() to register
+    # flushers and thresholds; the buffer is flushed on the final close(),
+    # before on_close and the exit stack, and discarded if the session is
+    # left with an exception.
+    def write_buffer(self):
+        return WriteBuffer()
+
+    @property
+    def buffer(self):
+        if self._buffer is None:
+            self._buffer = self.write_buffer()
+        return self._buffer
+
+    def defer(self, key, op, target=None):
+        self.buffer.defer(key, op, target)
+
+    def flush(self):
+        if self._buffer is not None:
+            self._buffer.flush()
+
+    def _discard_on_error(self, exc_type):
+        if exc_type is not None and self._depth == 1 and \
+                self._buffer is not None and self._buffer.discard_on_error:
+            self._buffer.discard()
+
+
+    # A picklable (class, args, kwargs) description of how to build an
+    # equivalent session elsewhere, e.g. in a worker process. Subclasses
+    # taking constructor arguments should override it.
+    def recipe(self):
+        if self._contexts:
+            raise TypeError('{} was built from context manager instances; '
+                            'override recipe() to rebuild it'.format(self))
+        return type(self), (), {}
+
+    @staticmethod
+    def from_recipe(recipe):
+        cls, args, kwargs = recipe
+        return cls(*args, **kwargs)
+
+
+    # A child session of the same class, sharing this one's state (the context
+    # objects stored on it and the lazy contexts it materialized) without
+    # running __init__ or enter_contexts() again. It has its own observables,
+    # function stack, caches and buffer, and enters only the contexts given
+    # here. While it's open, our final close leaves us but defers the
+    # teardown to the last fork to close.
+    def fork(self, *contextmanagers, timeout=None):
+        cls = type(self)
+        child = cls.__new__(cls)
+        child._contexts = contextmanagers
+        child.timeout = timeout
+        child._parent = self
+        return child
+
+    @property
+    def parent(self):
+        return self._parent
+
+    # The shared state is copied on every open, under the parent's lock, so a
+    # reopened fork sees what the parent's current open entered.
+    def _borrow(self):
+        parent = self._parent
+        with parent._lock:
+            if not parent._depth:
+                raise SessionlessError('{} is not open'.format(parent))
+            parent._forks += 1
+            for name in _shared_slots(type(self)):
+                try:
+                    setattr(self, name, getattr(parent, name))
+                except AttributeError:
+                    pass
+            if hasattr(parent, '__dict__'):
+                self.__dict__.update(parent.__dict__)
+        self._exit_stack.callback(parent._return)
+
+    def _return(self):
+        with self._lock:
+            self._forks -= 1
+            deferred = None
+            if not self._forks:
+                deferred, self._deferred = self._deferred, None
+        if deferred is not None:
+            self._finish_deferred(*deferred)
+
+    # Called after the final leave: with forks still open, the detached exit
+    # stack is kept for the last of them to tear down, and _closing stays
+    # pending (so we can't be reopened) until it does. No fork can borrow us
+    # once we're left, so the count is checked before taking the lock.
+    def _defer_close(self, exit_stack, make_future):
+        if not self._forks:
+            return None
+        with self._lock:
+            if not self._forks:
+                return None
+            future = make_future()
+            self._deferred = exit_stack, future
+            self._closing = future
+        logger.info('%s session teardown deferred to its forks', self)
+        return future
+
+    def _finish_deferred(self, exit_stack, future):
+        recorder = _metrics.recorder
+        start = recorder and perf_counter()
+        if isinstance(exit_stack, AsyncExitStack):
+            # Async contexts belong to the loop they were opened on.
+            future.get_loop().call_soon_threadsafe(
+                asyncio.ensure_future,
+                self._afinish_into(future, exit_stack, recorder, start))
+        else:
+            self._finish_into(future, exit_stack, recorder, start)
+
+
+    @classmethod
+    def lazy_contexts(cls):
+        return tuple(name for name in dir(cls)
+                     if isinstance(getattr(cls, name, None), lazycontext))
+
+    @property
+    def materialized(self):
+        return tuple(self._materialized or ())
+
+    # Values of lazy contexts materialized by this session or the ones it was
+    # forked from, or the missing default.
+    def _lazy_value(self, name, default=None):
+        session = self
+        while session is not None:
+            materialized = session._materialized
+            if materialized and name in materialized:
+                return materialized[name]
+            session = session._parent
+        return default
+
+    # Reentrant, so lazy contexts can use each other while being entered.
+    def _materialize_lock(self):
+        if self._lazy_lock is None:
+            with self._lock:
+                if self._lazy_lock is None:
+                    self._lazy_lock = threading.RLock()
+        return self._lazy_lock
+
+    def _materialize(self, name, context):
+        if not self.opened:
+            raise SessionlessError('{} is not open'.format(self))
+        if not hasattr(context, '__enter__'):
+            raise TypeError('Lazy context {!r} must be a synchronous context '
+                            'manager'.format(name))
+
+        # Registered before entering, so the cached value is dropped right
+        # after the context exits.
+        self._exit_stack.callback(self._forget, name)
+        context_obj = self._exit_stack.enter_context(context)
+        if self._materialized is None:
+            self._materialized = {}
+        self._materialized[name] = context_obj
+        return context_obj
+
+    def _forget(self, name):
+        if self._materialized is not None:
+            self._materialized.pop(name, None)
+
+
+    def _sessionaware_call(self, func):
+        call = getattr(func, '_sessionaware_call', None)
+        if call is None:
+            call = sessionaware(func, cls=type(self))._sessionaware_call
+        return call
+
+    def bind(self, func):
+        # Pre-bound callables skip the session lookup and re-entry done by
+        # sessionaware; they only make this (already open) session current.
+        call = self._sessionaware_call(func)
+        session = self
+
+        if iscoroutinefunction(call):
+            @wraps(func)
+            async def bound(*args, **kwargs):
+                if not session._depth:
+                    raise SessionlessError('{} is not open'.format(session))
+                node = _session_stack.get()
+                if node and node[0] is session:
+                    return await call(session, (session,) + args, kwargs)
+                token = _session_stack.set((session, node))
+                try:
+                    return await call(session, (session,) + args, kwargs)
+                finally:
+                    _session_stack.reset(token)
+
+        else:
+            @wraps(func)
+            def bound(*args, **kwargs):
+                if not session._depth:
+                    raise SessionlessError('{} is not open'.format(session))
+                node = _session_stack.get()
+                if node and node[0] is session:
+                    return call(session, (session,) + args, kwargs)
+                token = _session_stack.set((session, node))
+                try:
+                    return call(session, (session,) + args, kwargs)
+                finally:
+                    _session_stack.reset(token)
+
+        return bound
+
+
+    def map(self, func, *iterables, chunksize=1, max_workers=None):
+        return self.starmap(func, zip(*iterables), chunksize=chunksize,
+                            max_workers=max_workers)
+
+    def starmap(self, func, iterable, chunksize=1, max_workers=None):
+        if chunksize < 1:
+            raise ValueError('chunksize must be at least 1')
+        call = self._sessionaware_call(func)
+        if iscoroutinefunction(call):
+            raise TypeError('map() does not support coroutine functions')
+
+        if max_workers is None:
+            return self._starmap(call, iterable)
+        return self._starmap_threaded(call, iterable, chunksize, max_workers)
+
+    # The session is entered once, in a private copy of the caller's context,
+    # and every call runs inside that context: the session is current for the
+    # call without being re-entered or left on the caller's stack.
+    def _starmap(self, call, iterable):
+        context = copy_context()
+        context.run(self.open)
+        try:
+            for args in iterable:
+                yield context.run(call, self, (self,) + tuple(args), {})
+        finally:
+            context.run(self.close)
+
+    def _starmap_threaded(self, call, iterable, chunksize, max_workers):
+        def run_chunk(chunk):
+            return [call(self, (self,) + tuple(args), {}) for args in chunk]
+
+        iterator = iter(iterable)
+        chunks = iter(lambda: list(islice(iterator, chunksize)), [])
+
+        context = copy_context()
+        context.run(self.open)
+        pending = deque()
+        try:
+            with ThreadPoolExecutor(max_workers) as executor:
+                # Results are yielded in order, with a bounded number of
+                # chunks in flight.
+                try:
+                    for chunk in chunks:
+                        pending.append(executor.submit(
+                            context.copy().run, run_chunk, chunk))
+                        if len(pending) >= 2 * max_workers:
+                            yield from pending.popleft().result()
+                    while pending:
+                        yield from pending.popleft().result()
+                finally:
+                    # Before the executor's shutdown waits for them.
+                    for future in pending:
+                        future.cancel()
+        finally:
+            context.run(self.close)
 
     @property
     def opened(self):
-        return getattr(self, '_opened', False)
+        return self._depth > 0
 
+    @property
+    def depth(self):
+        return self._depth
 
-    def open(self):
+
+    # While the first open runs, entries from other threads wait for it to
+    # finish (opening the session themselves if it failed) rather than use a
+    # session whose contexts aren't entered yet. The opener's own nested
+    # entries, with the session already on their stack, go through.
+    def _try_reenter(self):
+        with self._lock:
+            if self._opening and not self._on_stack():
+                return None
+            self._depth += 1
+            depth = self._depth
+            if depth == 1:
+                self._opening = True
         self.__class__._push(self)
-        if self.opened:
-            self.on_enter()
-            logger.info('{} session entered'.format(self))
-            return
+        return depth
+
+    def _on_stack(self):
+        node = _session_stack.get()
+        while node:
+            if node[0] is self:
+                return True
+            node = node[1]
+        return False
+
+    def _opened(self):
+        with self._lock:
+            self._opening = False
+            if self._changed is not None:
+                self._changed.notify_all()
+
+    def _reenter(self):
+        depth = self._try_reenter()
+        while depth is None:
+            self._wait_opened()
+            depth = self._try_reenter()
+        return depth > 1 and self._entered()
+
+    async def _areenter(self):
+        depth = self._try_reenter()
+        while depth is None:
+            await asyncio.get_running_loop().run_in_executor(
+                None, self._wait_opened)
+            depth = self._try_reenter()
+        return depth > 1 and self._entered()
+
+    def _entered(self):
+        if self._on_enter is not None:
+            self._on_enter()
+        recorder = _metrics.recorder
+        if recorder:
+            recorder.record_reentry(self)
+        logger.info('%s session entered', self)
+        return True
+
+    # The final leave detaches the exit stack and state under the same lock
+    # as the depth and returns the stack: the session reads as closed at once
+    # (even while a background teardown runs), and a reopen racing with the
+    # teardown from another thread starts from a clean slate.
+    def _leave(self):
+        with self._lock:
+            if not self._depth:
+                raise SessionlessError('{} is not open'.format(self))
+            self._depth -= 1
+            exit_stack = None
+            if not self._depth:
+                exit_stack, self._exit_stack = self._exit_stack, None
+                self._caches = self._deadline = None
+        self._leave_stack()
+        if exit_stack is not None:
+            return exit_stack
+        if self._on_leave is not None:
+            self._on_leave()
+        logger.info('%s session left', self)
+        return None
+
+
+    def _pin(self):
+        with self._lock:
+            self._pins += 1
+
+    def _unpin(self):
+        with self._lock:
+            self._pins -= 1
+            if not self._pins and self._changed is not None:
+                self._changed.notify_all()
+
+    def _wait_unpinned(self):
+        with self._lock:
+            while self._pins:
+                self._wait_changed()
+
+    def _wait_opened(self):
+        with self._lock:
+            while self._opening:
+                self._wait_changed()
+
+    # Called with the lock held.
+    def _wait_changed(self):
+        if self._changed is None:
+            self._changed = threading.Condition(self._lock)
+        self._changed.wait()
+
+
+    def _enter_context(self, context):
+        recorder = _metrics.recorder
+        if not recorder:
+            return self._push_context(context)
+
+        # The exit is timed between two callbacks bracketing the context on
+        # the exit stack.
+        timer = _metrics.ContextTimer(recorder, self, context)
+        self._exit_stack.callback(timer.exited)
+        context_obj = self._push_context(context)
+        timer.entered()
+        self._exit_stack.callback(timer.exiting)
+        return context_obj
+
+    async def _aenter_context(self, context):
+        recorder = _metrics.recorder
+        if not recorder:
+            return await self._apush_context(context)
+
+        timer = _metrics.ContextTimer(recorder, self, context)
+        self._exit_stack.callback(timer.exited)
+        context_obj = await self._apush_context(context)
+        timer.entered()
+        self._exit_stack.callback(timer.exiting)
+        return context_obj
+
+    def _push_context(self, context):
+        if isinstance(context, parallel):
+            values, stacks = context.enter()
+            for stack in stacks:
+                self._exit_stack.enter_context(stack)
+            return values
+        if isinstance(context, retrying):
+            attempt = 1
+            while True:
+                try:
+                    return self._push_context(context.func())
+                except context.retry_on as e:
+                    delay = self._retry_delay(context, attempt, e)
+                    if delay is None:
+                        raise
+                sleep(delay)
+                attempt += 1
+        return self._exit_stack.enter_context(context)
+
+    async def _apush_context(self, context):
+        if isinstance(context, parallel):
+            values, stacks = await context.aenter()
+            for stack in stacks:
+                if isinstance(stack, AsyncExitStack):
+                    await self._exit_stack.enter_async_context(stack)
+                else:
+                    self._exit_stack.enter_context(stack)
+            return values
+        if isinstance(context, retrying):
+            attempt = 1
+            while True:
+                try:
+                    return await self._apush_context(context.func())
+                except context.retry_on as e:
+                    delay = self._retry_delay(context, attempt, e)
+                    if delay is None:
+                        raise
+                await asyncio.sleep(delay)
+                attempt += 1
+        if hasattr(context, '__aenter__'):
+            return await self._exit_stack.enter_async_context(context)
+        return self._exit_stack.enter_context(context)
 
+
+    # None once the policy is exhausted, or when the backoff would run past
+    # the deadline.
+    def _retry_delay(self, policy, attempt, error):
+        if attempt >= policy.attempts:
+            return None
+        delay = policy.delay(attempt)
+        remaining = self.remaining()
+        if remaining is not None and delay >= remaining:
+            return None
+
+        recorder = _metrics.recorder
+        if recorder:
+            recorder.record_retry(self)
+        logger.warning('%s retrying %s in %.3fs after %r (attempt %d of %d)',
+                       self, _metrics.context_name(policy), delay, error,
+                       attempt + 1, policy.attempts)
+        return delay
+
+    # A failed open leaves nothing behind: the session is taken off the stack
+    # as if never opened, and the contexts entered so far are exited in
+    # reverse order with the error.
+    def _rollback(self):
+        self.__class__._pop()
+        with self._lock:
+            self._depth -= 1
+            exit_stack, self._exit_stack = self._exit_stack, None
+            self._caches = self._deadline = self._opened_at = None
+            self._opening = False
+            if self._changed is not None:
+                self._changed.notify_all()
+
+        recorder = _metrics.recorder
+        if recorder:
+            recorder.record_rollback(self)
+        logger.info('%s session open rolled back', self)
+        return exit_stack
+
+
+    def open(self):
+        if self._closing is not None:
+            self._check_closing()
+        if self._parent is not None and not self._depth and \
+                not self._parent._depth:
+            raise SessionlessError('{} is not open'.format(self._parent))
+        if self._reenter():
+            return self
+
+        recorder = _metrics.recorder
+        start = recorder and perf_counter()
         self._exit_stack = ExitStack()
+        try:
+            self._start_deadline()
+            # Forks borrow their parent's resources and aren't counted.
+            admission = self._parent is None and self.admission
+            if admission:
+                admission.acquire(self.remaining())
+                self._exit_stack.callback(admission.release)
+            if self._parent is None:
+                enter_contexts = self.enter_contexts()
+            else:
+                self._borrow()
+                enter_contexts = Session.enter_contexts(self)
+            try:
+                context = next(enter_contexts)
+                while True:
+                    context_obj = self._enter_context(context)
+                    context = enter_contexts.send(context_obj)
+            except StopIteration:
+                pass
+
+            if self._on_open is not None:
+                self._on_open()
+        except BaseException:
+            self._rollback().__exit__(*sys.exc_info())
+            raise
+        self._opened()
+
+        if recorder:
+            self._opened_at = start
+            recorder.record_open(self, perf_counter() - start)
+
+        logger.info('%s session opened', self)
+
+        return self
+
+
+    def close(self, background=False):
+        if self._depth == 1:
+            if isinstance(self._exit_stack, AsyncExitStack):
+                raise RuntimeError('{} was opened asynchronously, '
+                                   'use aclose()'.format(self))
+            # Tasks still running on this session keep it from closing.
+            self._wait_unpinned()
 
-        enter_contexts = self.enter_contexts()
+        exit_stack = self._leave()
+        if exit_stack is None:
+            return None
+        future = self._defer_close(exit_stack, Future)
+        if future is not None:
+            return future
+
+        recorder = _metrics.recorder
+        start = recorder and perf_counter()
+        if not background:
+            return self._finish_close(exit_stack, recorder, start)
+
+        self._closing = self._submit_close(background, exit_stack, recorder,
+                                           start)
+        return self._closing
+
+    # background is True or the TeardownWorker to hand the teardown to. The
+    # exit stack is already detached, so if the worker can't take it (it was
+    # shut down) the teardown runs here rather than never.
+    def _submit_close(self, background, exit_stack, recorder, start):
+        worker = background if isinstance(background, TeardownWorker) \
+            else default_worker()
         try:
-            context = next(enter_contexts)
-            while True:
-                context_obj = self._exit_stack.enter_context(context)
-                context = enter_contexts.send(context_obj)
-        except StopIteration:
-            pass
+            return worker.submit(copy_context().run, self._finish_close,
+                                 exit_stack, recorder, start)
+        except RuntimeError:
+            logger.warning('%s tearing down inline, %s refused it',
+                           self, worker)
+
+        future = Future()
+        self._finish_into(future, exit_stack, recorder, start)
+        return future
+
+    def _finish_into(self, future, exit_stack, recorder, start):
+        try:
+            future.set_result(self._finish_close(exit_stack, recorder, start))
+        except BaseException as e:
+            logger.exception('Error in teardown of %s', self)
+            future.set_exception(e)
+
+    def _check_closing(self):
+        if not self._closing.done():
+            raise RuntimeError('{} is still being torn down'.format(self))
+        self._closing = None
+
+    # on_close subscribers, the exit stack and the close metrics all run
+    # even when the flush fails; its error is raised after them.
+    def _finish_close(self, exit_stack, recorder, start):
+        try:
+            try:
+                self.flush()
+            finally:
+                if self._on_close is not None:
+                    self._on_close()
+        finally:
+            exit_stack.close()
+            if recorder:
+                self._record_close(recorder, start)
+            logger.info('%s session closed', self)
+
+
+    async def aopen(self):
+        if self._closing is not None:
+            self._check_closing()
+        if self._parent is not None and not self._depth and \
+                not self._parent._depth:
+            raise SessionlessError('{} is not open'.format(self._parent))
+        if await self._areenter():
+            return self
+
+        recorder = _metrics.recorder
+        start = recorder and perf_counter()
+        self._exit_stack = AsyncExitStack()
+        try:
+            self._start_deadline()
+            admission = self._parent is None and self.admission
+            if admission:
+                await admission.aacquire(self.remaining())
+                self._exit_stack.callback(admission.release)
+            # enter_contexts may be a plain or an async generator, and may
+            # yield sync or async context managers.
+            if self._parent is None:
+                enter_contexts = self.enter_contexts()
+            else:
+                self._borrow()
+                enter_contexts = Session.enter_contexts(self)
+            is_async = isinstance(enter_contexts, AsyncGeneratorType)
+            context_obj = None
+            try:
+                while True:
+                    if is_async:
+                        context = await enter_contexts.asend(context_obj)
+                    else:
+                        context = enter_contexts.send(context_obj)
+
+                    context_obj = await self._aenter_context(context)
+            except (StopIteration, StopAsyncIteration):
+                pass
+
+            if self._on_open is not None:
+                self._on_open()
+        except BaseException:
+            await self._rollback().__aexit__(*sys.exc_info())
+            raise
+        self._opened()
 
-        self.on_open()
+        if recorder:
+            self._opened_at = start
+            recorder.record_open(self, perf_counter() - start)
 
-        self._opened = True
-        logger.info('{} session opened'.format(self))
+        logger.info('%s session opened', self)
 
         return self
 
 
-    def close(self):
-        self.__class__._pop()
-        if self in self.__class__._sessions:
-            self.on_leave()
-            logger.info('{} session left'.format(self))
-            return
+    async def aclose(self, background=False):
+        if self._depth == 1 and self._pins:
+            await asyncio.get_running_loop().run_in_executor(
+                None, self._wait_unpinned)
+
+        exit_stack = self._leave()
+        if exit_stack is None:
+            return None
+        if isinstance(exit_stack, AsyncExitStack):
+            future = self._defer_close(
+                exit_stack, asyncio.get_running_loop().create_future)
+        else:
+            future = self._defer_close(exit_stack, Future)
+            if future is not None:
+                future = asyncio.wrap_future(future)
+        if future is not None:
+            return future
+
+        recorder = _metrics.recorder
+        start = recorder and perf_counter()
+        if not background:
+            return await self._afinish_close(exit_stack, recorder, start)
 
+        # Async contexts belong to this loop, so they're torn down in a task
+        # on it rather than by the worker.
+        if isinstance(exit_stack, AsyncExitStack):
+            self._closing = asyncio.ensure_future(
+                self._afinish_close(exit_stack, recorder, start))
+            return self._closing
+
+        self._closing = self._submit_close(background, exit_stack, recorder,
+                                           start)
+        return asyncio.wrap_future(self._closing)
+
+    async def _afinish_close(self, exit_stack, recorder, start):
         try:
-            self.on_close()
+            try:
+                self.flush()
+            finally:
+                if self._on_close is not None:
+                    self._on_close()
         finally:
-            self._exit_stack.close()
+            if isinstance(exit_stack, AsyncExitStack):
+                await exit_stack.aclose()
+            else:
+                exit_stack.close()
+            if recorder:
+                self._record_close(recorder, start)
+            logger.info('%s session closed', self)
+
+    async def _afinish_into(self, future, exit_stack, recorder, start):
+        try:
+            future.set_result(
+                await self._afinish_close(exit_stack, recorder, start))
+        except BaseException as e:
+            logger.exception('Error in teardown of %s', self)
+            future.set_exception(e)
 
-        logger.info('{} session closed'.format(self))
+    def _record_close(self, recorder, start):
+        end = perf_counter()
+        opened_at, self._opened_at = self._opened_at, None
+        recorder.record_close(self, end - start,
+                              None if opened_at is None else end - opened_at)
+
+
+    @classmethod
+    def metrics(cls):
+        return _metrics.snapshot(cls)
 
 
     def __enter__(self):
         return self.open()
 
-    def __exit__(self, *exc_info):
+    def __exit__(self, exc_type, exc, tb):
+        self._discard_on_error(exc_type)
         self.close()
 
+    async def __aenter__(self):
+        return await self.aopen()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._discard_on_error(exc_type)
+        await self.aclose()
+
+
+# Attributes subclasses declare in __slots__, which a fork copies from its
+# parent along with the instance __dict__ when it opens.
+@lru_cache(maxsize=None)
+def _shared_slots(cls):
+    names = []
+    for klass in cls.__mro__:
+        if klass is Session:
+            break
+        slots = klass.__dict__.get('__slots__', ())
+        names.extend(n for n in ((slots,) if isinstance(slots, str) else slots)
+                     if n not in ('__dict__', '__weakref__'))
+    return tuple(names)
+
+
+def _split_results(results):
+    stacks = [r[1] for r in results if not isinstance(r, BaseException)]
+    errors = [r for r in results if isinstance(r, BaseException)]
+    return stacks, errors
+
+
+def _close_stacks(stacks):
+    for stack in reversed(stacks):
+        try:
+            stack.close()
+        except Exception:
+            logger.exception('Error closing %s', stack)
+
+
+async def _aclose_stacks(stacks):
+    for stack in reversed(stacks):
+        try:
+            if isinstance(stack, AsyncExitStack):
+                await stack.aclose()
+            else:
+                stack.close()
+        except Exception:
+            logger.exception('Error closing %s', stack)
+
+
+# A group of independent contexts that enter_contexts() can yield as one item.
+# They are entered concurrently (on threads, or with asyncio.gather for async
+# sessions) and the tuple of their values is sent back to enter_contexts().
+# If any of them fails, the ones already entered are exited before raising.
+class parallel(object):
+    def __init__(self, *contexts):
+        self.contexts = contexts
+
+    @staticmethod
+    def _enter_one(context):
+        stack = ExitStack()
+        return stack.enter_context(context), stack
+
+    def enter(self):
+        if not self.contexts:
+            return (), []
+
+        # The first context is entered on the calling thread, the others on
+        # worker threads that see the caller's context variables.
+        with ThreadPoolExecutor(max(len(self.contexts) - 1, 1)) as executor:
+            futures = [executor.submit(copy_context().run, self._enter_one, c)
+                       for c in self.contexts[1:]]
+            results = []
+            try:
+                results.append(self._enter_one(self.contexts[0]))
+            except BaseException as e:
+                results.append(e)
+            for future in futures:
+                try:
+                    results.append(future.result())
+                except BaseException as e:
+                    results.append(e)
+
+        stacks, errors = _split_results(results)
+        if errors:
+            _close_stacks(stacks)
+            raise errors[0]
+        return tuple(r[0] for r in results), stacks
+
+    async def aenter(self):
+        async def _enter_one(context):
+            if hasattr(context, '__aenter__'):
+                stack = AsyncExitStack()
+                return await stack.enter_async_context(context), stack
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                None, copy_context().run, self._enter_one, context)
+
+        results = await asyncio.gather(
+            *(_enter_one(c) for c in self.contexts), return_exceptions=True)
+
+        stacks, errors = _split_results(results)
+        if errors:
+            await _aclose_stacks(stacks)
+            raise errors[0]
+        return tuple(r[0] for r in results), stacks
+
+
+# Retry policy for a context yielded by enter_contexts(), built by func() on
+# each attempt since a failed context manager can't be entered again. Enter
+# errors matching retry_on are retried up to `attempts` tries in all, after an
+# exponential backoff (backoff * 2 ** n, capped at max_backoff) from which up
+# to `jitter` of it is randomly taken off, so clients don't retry in lockstep.
+# Backoffs that would run past the session's deadline aren't waited out.
+#
+#     def enter_contexts(self):
+#         self.db = yield retrying(self.connect, attempts=5,
+#                                  retry_on=ConnectionError)
+class retrying(object):
+    def __init__(self, func, attempts=3, backoff=0.1, max_backoff=None,
+                 jitter=1.0, retry_on=Exception):
+        if attempts < 1:
+            raise ValueError('attempts must be at least 1')
+        if not 0 <= jitter <= 1:
+            raise ValueError('jitter must be between 0 and 1')
+        self.func = func
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.retry_on = retry_on
+
+    def delay(self, attempt):
+        delay = self.backoff * 2 ** (attempt - 1)
+        if self.max_backoff is not None:
+            delay = min(delay, self.max_backoff)
+        return delay * (1 - self.jitter * random.random())
+
+
+# Declares a session attribute whose context manager (returned by the decorated
+# method) is entered on first access rather than on open(), then cached on the
+# instance until the exit stack unwinds. First accesses are serialized per
+# session, so concurrent sessions don't wait for each other's contexts.
+class lazycontext(object):
+    def __init__(self, factory):
+        self.factory = factory
+        self.name = factory.__name__
+        self.__doc__ = factory.__doc__
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, session, owner=None):
+        if session is None:
+            return self
+
+        value = session._lazy_value(self.name, _MISSING)
+        if value is not _MISSING:
+            return value
+        with session._materialize_lock():
+            value = session._lazy_value(self.name, _MISSING)
+            if value is not _MISSING:
+                return value
+            return session._materialize(self.name, self.factory(session))
+
+
+# Read-ahead for sessionaware generators: the wrapped generator runs on a
+# worker thread, in a copy of the consumer's context with the session current,
+# up to `size` items ahead of the consumer. Errors and the return value reach
+# the consumer in position; closing the consumer stops the producer and waits
+# for the wrapped generator to close. Values can't be sent to it.
+def _prefetch(session, generator, size):
+    buffer = deque()
+    ready = threading.Condition()
+    stopping = False
+
+    def produce():
+        try:
+            while True:
+                # Wait for room before stepping, so at most `size` items
+                # are produced and not yet consumed.
+                with ready:
+                    while len(buffer) >= size and not stopping:
+                        ready.wait()
+                    if stopping:
+                        return
+                try:
+                    entry = ('item', next(generator))
+                except StopIteration as stop:
+                    entry = ('return', stop.value)
+                except BaseException as e:
+                    entry = ('error', e)
+                with ready:
+                    buffer.append(entry)
+                    ready.notify()
+                if entry[0] != 'item':
+                    return
+        finally:
+            generator.close()
+
+    context = copy_context()
+    node = context.run(_session_stack.get)
+    if not node or node[0] is not session:
+        context.run(_session_stack.set, (session, node))
+    producer = threading.Thread(target=context.run, args=(produce,),
+                                name='sessionlib-prefetch', daemon=True)
+    producer.start()
+    try:
+        while True:
+            with ready:
+                while not buffer:
+                    ready.wait()
+                kind, value = buffer.popleft()
+                ready.notify()
+            if kind == 'return':
+                return value
+            if kind == 'error':
+                raise value
+            if (yield value) is not None:
+                raise TypeError("can't send values to a prefetching generator")
+    finally:
+        with ready:
+            stopping = True
+            ready.notify_all()
+        producer.join()
+
+
+# Same for async generators, with a task as the producer.
+async def _aprefetch(session, generator, size):
+    queue = asyncio.Queue()
+    room = asyncio.Semaphore(size)
+
+    async def produce():
+        node = _session_stack.get()
+        if not node or node[0] is not session:
+            _session_stack.set((session, node))
+        try:
+            while True:
+                await room.acquire()
+                try:
+                    entry = ('item', await generator.__anext__())
+                except StopAsyncIteration:
+                    entry = ('return', None)
+                except asyncio.CancelledError:
+                    raise
+                except BaseException as e:
+                    entry = ('error', e)
+                queue.put_nowait(entry)
+                if entry[0] != 'item':
+                    return
+        finally:
+            await generator.aclose()
+
+    # The task runs in a copy of this context.
+    producer = asyncio.ensure_future(produce())
+    try:
+        while True:
+            kind, value = await queue.get()
+            room.release()
+            if kind == 'return':
+                return
+            if kind == 'error':
+                raise value
+            if (yield value) is not None:
+                raise TypeError("can't send values to a prefetching generator")
+    finally:
+        producer.cancel()
+        try:
+            await producer
+        except asyncio.CancelledError:
+            pass
+
+
+def sessionaware(function=None, cls=Session, batch=None, prefetch=None):
+    if batch is not None and batch < 1:
+        raise ValueError('batch must be a positive number of items')
+    if prefetch is not None and prefetch < 1:
+        raise ValueError('prefetch must be a positive number of items')
 
-def sessionaware(function=None, cls=Session):
     def _decorate(func):
+        # Generator functions are timed over the steps run inside their body;
+        # any other function over its call.
+        generator_function = isgeneratorfunction(func) or \
+            isasyncgenfunction(func)
+
+        # The wrappers below drive the generator by hand, with yield from
+        # semantics: values passed to send() and exceptions passed to throw()
+        # reach the wrapped generator, and its return value is preserved.
+        # The function frame is only pushed while the generator body runs.
         @wraps(func)
         def _handle_generator(session, func, response):
-            session._push_function(func)
+            recorder = generator_function and _metrics.recorder
+            elapsed = 0.0
+            value = error = None
             try:
-                for item in response:
-                    session._pop_function()
-                    yield item
-                    session._push_function(func)
-            except GeneratorExit:
-                session._push_function(func)
+                while True:
+                    if session._deadline is not None and error is None:
+                        session.check_deadline()
+                    token = _function_stack.set(
+                        (session, func, _function_stack.get()))
+                    start = recorder and perf_counter()
+                    try:
+                        if error is None:
+                            item = response.send(value)
+                        else:
+                            error, exc = None, error
+                            item = response.throw(exc)
+                    except StopIteration as stop:
+                        return stop.value
+                    finally:
+                        _function_stack.reset(token)
+                        if recorder:
+                            elapsed += perf_counter() - start
+
+                    try:
+                        value = yield item
+                    except GeneratorExit:
+                        token = _function_stack.set(
+                            (session, func, _function_stack.get()))
+                        try:
+                            response.close()
+                        finally:
+                            _function_stack.reset(token)
+                        raise
+                    except BaseException as exc:
+                        value, error = None, exc
             finally:
-                session._pop_function()
+                if recorder:
+                    recorder.record_function(func, elapsed)
 
 
         @wraps(func)
-        def wrapped(*args, **kwargs):
-            current_session = cls.current()
-
-            if args and isinstance(args[0], cls):
-                session = args[0]
-            elif current_session:
-                session = current_session
-                args = (session,) + args
-            else:
-                raise SessionlessError('No session is currently active')
+        async def _handle_async_generator(session, func, response):
+            recorder = generator_function and _metrics.recorder
+            elapsed = 0.0
+            value = error = None
+            try:
+                while True:
+                    if session._deadline is not None and error is None:
+                        session.check_deadline()
+                    token = _function_stack.set(
+                        (session, func, _function_stack.get()))
+                    start = recorder and perf_counter()
+                    try:
+                        if error is None:
+                            item = await response.asend(value)
+                        else:
+                            error, exc = None, error
+                            item = await response.athrow(exc)
+                    except StopAsyncIteration:
+                        return
+                    finally:
+                        _function_stack.reset(token)
+                        if recorder:
+                            elapsed += perf_counter() - start
+
+                    try:
+                        value = yield item
+                    except GeneratorExit:
+                        token = _function_stack.set(
+                            (session, func, _function_stack.get()))
+                        try:
+                            await response.aclose()
+                        finally:
+                            _function_stack.reset(token)
+                        raise
+                    except BaseException as exc:
+                        value, error = None, exc
+            finally:
+                if recorder:
+                    recorder.record_function(func, elapsed)
 
-            session._push_function(func)
+
+        # Batched mode: up to `batch` items are pulled per frame push and
+        # yielded to the consumer as one list.
+        @wraps(func)
+        def _handle_batches(session, func, response):
+            recorder = generator_function and _metrics.recorder
+            elapsed = 0.0
             try:
-                if session is current_session:
-                    response = func(*args, **kwargs)
-                else:
-                    with session:
-                        response = func(*args, **kwargs)
+                while True:
+                    if session._deadline is not None:
+                        session.check_deadline()
+                    token = _function_stack.set(
+                        (session, func, _function_stack.get()))
+                    start = recorder and perf_counter()
+                    # extend() keeps the items read before an error, which
+                    # is raised after they're delivered.
+                    chunk, error = [], None
+                    try:
+                        chunk.extend(islice(response, batch))
+                    except Exception as e:
+                        error = e
+                    finally:
+                        _function_stack.reset(token)
+                        if recorder:
+                            elapsed += perf_counter() - start
+
+                    if chunk:
+                        yield chunk
+                    if error is not None:
+                        raise error
+                    if len(chunk) < batch:
+                        return
+            finally:
+                token = _function_stack.set(
+                    (session, func, _function_stack.get()))
+                try:
+                    response.close()
+                finally:
+                    _function_stack.reset(token)
+                    if recorder:
+                        recorder.record_function(func, elapsed)
+
+
+        @wraps(func)
+        async def _handle_async_batches(session, func, response):
+            recorder = generator_function and _metrics.recorder
+            elapsed = 0.0
+            try:
+                while True:
+                    if session._deadline is not None:
+                        session.check_deadline()
+                    token = _function_stack.set(
+                        (session, func, _function_stack.get()))
+                    start = recorder and perf_counter()
+                    chunk, error = [], None
+                    try:
+                        while len(chunk) < batch:
+                            chunk.append(await response.__anext__())
+                    except StopAsyncIteration:
+                        pass
+                    except Exception as e:
+                        error = e
+                    finally:
+                        _function_stack.reset(token)
+                        if recorder:
+                            elapsed += perf_counter() - start
+
+                    if chunk:
+                        yield chunk
+                    if error is not None:
+                        raise error
+                    if len(chunk) < batch:
+                        return
             finally:
-                session._pop_function()
+                token = _function_stack.set(
+                    (session, func, _function_stack.get()))
+                try:
+                    await response.aclose()
+                finally:
+                    _function_stack.reset(token)
+                    if recorder:
+                        recorder.record_function(func, elapsed)
+
+
+        if batch is not None:
+            generator_handler = _handle_batches
+            async_generator_handler = _handle_async_batches
+        else:
+            generator_handler = _handle_generator
+            async_generator_handler = _handle_async_generator
+
+        # Prefetching runs the handler chosen above (so batches, when set,
+        # are what's read ahead) on the producer.
+        if prefetch is not None:
+            step_handler = generator_handler
+            async_step_handler = async_generator_handler
+
+            def generator_handler(session, func, response):
+                return _prefetch(session, step_handler(
+                    session, func, response), prefetch)
+
+            def async_generator_handler(session, func, response):
+                return _aprefetch(session, async_step_handler(
+                    session, func, response), prefetch)
+
+
+        # The calling convention is resolved once here, so the per-call path
+        # below only has to find the session and bracket the call.
+        is_coroutine = iscoroutinefunction(func)
+
+        if is_coroutine:
+            async def call(session, args, kwargs):
+                deadline = session._deadline
+                if deadline is not None:
+                    session.check_deadline()
+                    if _enforced_deadline.get() != deadline:
+                        return await _call_with_deadline(session, args, kwargs)
+
+                token = _function_stack.set(
+                    (session, func, _function_stack.get()))
+                recorder = _metrics.recorder
+                start = recorder and perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    _function_stack.reset(token)
+                    if recorder:
+                        recorder.record_function(func, perf_counter() - start)
+
+            # The remaining budget becomes an asyncio timeout: the call is
+            # cancelled at the deadline and DeadlineExceeded raised instead.
+            async def _call_with_deadline(session, args, kwargs):
+                token = _enforced_deadline.set(session._deadline)
+                try:
+                    return await asyncio.wait_for(
+                        call(session, args, kwargs), session.remaining())
+                except DeadlineExceeded:
+                    raise
+                except asyncio.TimeoutError:
+                    # Timeouts of the function's own are not ours to rename.
+                    if session.remaining():
+                        raise
+                    raise DeadlineExceeded('{} ran out of time'.format(
+                        session)) from None
+                finally:
+                    _enforced_deadline.reset(token)
 
-            if isinstance(response, GeneratorType):
-                return _handle_generator(session, func, response)
+        else:
+            if isgeneratorfunction(func):
+                handler = generator_handler
+            elif isasyncgenfunction(func):
+                handler = async_generator_handler
             else:
+                handler = None
+
+            def call(session, args, kwargs):
+                if session._deadline is not None:
+                    session.check_deadline()
+                token = _function_stack.set(
+                    (session, func, _function_stack.get()))
+                recorder = handler is None and _metrics.recorder
+                start = recorder and perf_counter()
+                try:
+                    response = func(*args, **kwargs)
+                finally:
+                    _function_stack.reset(token)
+                    if recorder:
+                        recorder.record_function(func, perf_counter() - start)
+
+                if handler is not None:
+                    return handler(session, func, response)
+                elif type(response) is GeneratorType:
+                    return generator_handler(session, func, response)
+                elif type(response) is AsyncGeneratorType:
+                    return async_generator_handler(session, func, response)
                 return response
 
+
+        if is_coroutine:
+            @wraps(func)
+            async def wrapped(*args, **kwargs):
+                node = _session_stack.get()
+                current_session = node[0] if node else None
+
+                if args and isinstance(args[0], cls):
+                    session = args[0]
+                elif current_session is not None:
+                    session = current_session
+                    args = (session,) + args
+                else:
+                    raise SessionlessError('No session is currently active')
+
+                if session is current_session:
+                    return await call(session, args, kwargs)
+                async with session:
+                    return await call(session, args, kwargs)
+
+        else:
+            @wraps(func)
+            def wrapped(*args, **kwargs):
+                node = _session_stack.get()
+                current_session = node[0] if node else None
+
+                if args and isinstance(args[0], cls):
+                    session = args[0]
+                elif current_session is not None:
+                    session = current_session
+                    args = (session,) + args
+                else:
+                    raise SessionlessError('No session is currently active')
+
+                if session is current_session:
+                    return call(session, args, kwargs)
+                with session:
+                    return call(session, args, kwargs)
+
+        _frame_codes.update(c.__code__ for c in (
+            call, _handle_generator, _handle_async_generator,
+            _handle_batches, _handle_async_batches))
+        wrapped._sessionaware_call = call
         return wrapped
     
     return _decorate(function) if function else _decorate
-
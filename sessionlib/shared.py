@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+
+from .metrics import _name
+
+logger = logging.getLogger(__name__)
+
+
+class _Entry(object):
+    __slots__ = ('name', 'context', 'value', 'error', 'ready', 'holders',
+                 'peak', 'acquired', 'timer')
+
+    def __init__(self, name):
+        self.name = name
+        self.context = self.value = self.error = self.timer = None
+        self.ready = threading.Event()
+        self.holders = self.peak = self.acquired = 0
+
+
+class _SharedContext(object):
+    __slots__ = ('registry', 'key', 'factory', 'args', 'kwargs')
+
+    def __init__(self, registry, key, factory, args, kwargs):
+        self.registry = registry
+        self.key = key
+        self.factory = factory
+        self.args = args
+        self.kwargs = kwargs
+
+    # Holds no state of its own between enter and exit (released by key), so
+    # one handle can be entered by several sessions at once.
+    def __enter__(self):
+        return self.registry._acquire(self).value
+
+    def __exit__(self, exc_type, exc, tb):
+        self.registry._release(self.key)
+
+
+# Context managers shared by every session that asks for the same factory and
+# arguments: the first holder enters factory(*args, **kwargs), later ones get
+# the live object, and it's exited once the last holder leaves (linger seconds
+# later, if set, so back-to-back sessions don't churn it). Holders' exceptions
+# are never passed to the shared context.
+#
+#     def enter_contexts(self):
+#         self.replica = yield shared_resources(connect, 'replica-1')
+class SharedResources(object):
+    def __init__(self, linger=None):
+        self.linger = linger
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, factory, *args, **kwargs):
+        key = (factory, args, tuple(sorted(kwargs.items())))
+        return _SharedContext(self, key, factory, args, kwargs)
+
+    @property
+    def shares(self):
+        with self._lock:
+            return {e.name: e.holders for e in self._entries.values()}
+
+    def stats(self):
+        with self._lock:
+            return {e.name: {'holders': e.holders,
+                             'peak': e.peak,
+                             'acquired': e.acquired,
+                             'lingering': e.timer is not None}
+                    for e in self._entries.values()}
+
+
+    def _acquire(self, shared):
+        with self._lock:
+            entry = self._entries.get(shared.key)
+            creator = entry is None
+            if creator:
+                entry = self._entries[shared.key] = _Entry('{}{!r}'.format(
+                    _name(shared.factory), shared.args))
+            entry.holders += 1
+            entry.acquired += 1
+            entry.peak = max(entry.peak, entry.holders)
+            if entry.timer is not None:
+                entry.timer.cancel()
+                entry.timer = None
+
+        if not creator:
+            # Entered outside the lock, so others wait only for their key.
+            entry.ready.wait()
+            if entry.error is not None:
+                raise entry.error
+            return entry
+
+        try:
+            context = shared.factory(*shared.args, **shared.kwargs)
+            entry.value = context.__enter__()
+            entry.context = context
+        except BaseException as e:
+            with self._lock:
+                del self._entries[shared.key]
+            entry.error = e
+            raise
+        finally:
+            entry.ready.set()
+        return entry
+
+    def _release(self, key):
+        with self._lock:
+            entry = self._entries[key]
+            entry.holders -= 1
+            if entry.holders:
+                return
+            if self.linger:
+                entry.timer = timer = threading.Timer(
+                    self.linger, self._expire, (key, entry))
+                timer.daemon = True
+                timer.start()
+                return
+            del self._entries[key]
+        self._exit(entry)
+
+    def _expire(self, key, entry):
+        with self._lock:
+            # Reacquired (or lingering again on a newer timer) since.
+            if entry.holders or entry.timer is not threading.current_thread():
+                return
+            entry.timer = None
+            del self._entries[key]
+        self._exit(entry)
+
+    def _exit(self, entry):
+        try:
+            entry.context.__exit__(None, None, None)
+        except Exception:
+            logger.exception('Error exiting shared %s', entry.name)
+
+
+    # Exits lingering resources now; held ones are exited by their holders.
+    def close(self):
+        with self._lock:
+            expired = [(k, e) for k, e in self._entries.items()
+                       if e.timer is not None]
+            for key, entry in expired:
+                entry.timer.cancel()
+                entry.timer = None
+                del self._entries[key]
+
+        for _, entry in expired:
+            self._exit(entry)
+
+
+shared_resources = SharedResources()
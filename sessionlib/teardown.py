@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+import atexit
+import logging
+import queue
+import threading
+import time
+
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+
+# Runs session teardowns handed over by close(background=True). At most
+# max_pending teardowns wait in the queue: submitters block for a free slot,
+# and after timeout (if set) run the teardown themselves, so a backed up worker
+# slows closers down instead of piling up open resources.
+class TeardownWorker(object):
+    def __init__(self, max_pending=64, workers=1, timeout=None):
+        if max_pending < 1 or workers < 1:
+            raise ValueError('Expected max_pending >= 1 and workers >= 1')
+
+        self.max_pending = max_pending
+        self.workers = workers
+        self.timeout = timeout
+
+        self._queue = queue.Queue(max_pending)
+        self._threads = []
+        self._lock = threading.Lock()
+        self._shutdown = False
+
+        self._submitted = self._completed = self._failed = 0
+        self._inline = 0
+
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {
+                'pending': self._queue.unfinished_tasks,
+                'submitted': self._submitted,
+                'completed': self._completed,
+                'failed': self._failed,
+                'inline': self._inline,
+            }
+
+
+    def _start(self):
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError('{} is shut down'.format(self))
+            self._submitted += 1
+            if len(self._threads) < self.workers:
+                thread = threading.Thread(
+                    target=self._work, daemon=True,
+                    name='sessionlib-teardown-{}'.format(len(self._threads)))
+                thread.start()
+                self._threads.append(thread)
+
+    def _run(self, future, fn, args):
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            result = fn(*args)
+        except BaseException as e:
+            logger.exception('Error in background teardown %r', fn)
+            with self._lock:
+                self._failed += 1
+            future.set_exception(e)
+        else:
+            with self._lock:
+                self._completed += 1
+            future.set_result(result)
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                self._run(*item)
+            finally:
+                self._queue.task_done()
+
+
+    def submit(self, fn, *args):
+        self._start()
+        future = Future()
+        try:
+            self._queue.put((future, fn, args), timeout=self.timeout)
+        except queue.Full:
+            with self._lock:
+                self._inline += 1
+            self._run(future, fn, args)
+        return future
+
+    def drain(self, timeout=None):
+        # Waits for every submitted teardown; False if timeout expired first.
+        deadline = None if timeout is None else time.monotonic() + timeout
+        done = self._queue.all_tasks_done
+        with done:
+            while self._queue.unfinished_tasks:
+                remaining = None if deadline is None \
+                    else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                done.wait(remaining)
+        return True
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            self._shutdown = True
+            threads = list(self._threads)
+        for _ in threads:
+            self._queue.put(None)
+        if wait:
+            for thread in threads:
+                thread.join()
+
+
+_default_worker = None
+_default_lock = threading.Lock()
+
+
+def default_worker():
+    global _default_worker
+    if _default_worker is None:
+        with _default_lock:
+            if _default_worker is None:
+                _default_worker = TeardownWorker()
+    return _default_worker
+
+
+def drain_teardowns(timeout=None):
+    return _default_worker is None or _default_worker.drain(timeout)
+
+
+# Teardowns still in flight at interpreter exit are finished, not dropped.
+atexit.register(drain_teardowns)
@@ -1,22 +1,139 @@
 # -*- coding: utf-8 -*-
 
+import weakref
+
+from inspect import signature, Parameter
+
+
+def _positional_count(callback):
+    try:
+        parameters = signature(callback).parameters.values()
+    except (TypeError, ValueError):
+        # No introspectable signature (some builtins): assume the full
+        # (obj, params) convention.
+        return 2
+
+    positional = 0
+    for parameter in parameters:
+        if parameter.kind == Parameter.VAR_POSITIONAL:
+            return 2
+        if parameter.kind in (Parameter.POSITIONAL_ONLY,
+                              Parameter.POSITIONAL_OR_KEYWORD):
+            positional += 1
+    return min(positional, 2)
+
+
+class Subscription(object):
+    __slots__ = ('observable', 'callback', 'priority', 'order', 'weak',
+                 'nargs', '__weakref__')
+
+    def __init__(self, observable, callback, priority, order, weak):
+        self.observable = observable
+        self.priority = priority
+        self.order = order
+        self.weak = weak
+        self.nargs = _positional_count(callback)
+
+        if weak:
+            ref = weakref.WeakMethod if hasattr(callback, '__self__') and \
+                hasattr(callback, '__func__') else weakref.ref
+            self_ref = weakref.ref(self)
+
+            def _expired(_, self_ref=self_ref):
+                subscription = self_ref()
+                if subscription is not None:
+                    subscription.unsubscribe()
+
+            self.callback = ref(callback, _expired)
+        else:
+            self.callback = callback
+
+    @property
+    def active(self):
+        return self in self.observable._subscriptions
+
+    def unsubscribe(self):
+        self.observable._remove(self)
+
 
 class Observable(object):
+    __slots__ = ('obj', '_subscriptions', '_dispatch', '_order')
+
     def __init__(self, obj=None):
-        self.callbacks = []
         self.obj = obj
+        self._subscriptions = {}
+        self._dispatch = ()
+        self._order = 0
+
+    @property
+    def subscriptions(self):
+        return tuple(self._subscriptions)
+
+    @property
+    def callbacks(self):
+        callbacks = []
+        for subscription in self._subscriptions:
+            callback = subscription.callback
+            if subscription.weak:
+                callback = callback()
+            if callback is not None:
+                callbacks.append(callback)
+        return callbacks
+
+
+    def _compile(self):
+        # Highest priority first, then subscription order.
+        ordered = sorted(self._subscriptions,
+                         key=lambda s: (-s.priority, s.order))
+        self._dispatch = tuple((s.callback, s.weak, s.nargs) for s in ordered)
 
-    def subscribe(self, callback):
-        self.callbacks.append(callback)
+    def _remove(self, subscription):
+        if self._subscriptions.pop(subscription, False):
+            self._dispatch = None
+
+
+    def subscribe(self, callback, priority=0, weak=False):
+        self._order += 1
+        subscription = Subscription(self, callback, priority, self._order,
+                                    weak)
+        self._subscriptions[subscription] = True
+        self._dispatch = None
+        return subscription
 
     def unsubscribe(self, callback):
-        self.callbacks.remove(callback)
+        if isinstance(callback, Subscription):
+            return callback.unsubscribe()
+
+        for subscription in self._subscriptions:
+            target = subscription.callback
+            if subscription.weak:
+                target = target()
+            if target == callback:
+                return subscription.unsubscribe()
+        raise ValueError('{!r} is not subscribed'.format(callback))
+
+    def clear(self):
+        self._subscriptions.clear()
+        self._dispatch = ()
+
 
     def __call__(self, params=None):
-        for fn in self.callbacks:
-            if fn.__code__.co_argcount == 0:
+        dispatch = self._dispatch
+        if not dispatch:
+            if dispatch is not None:
+                return
+            self._compile()
+            dispatch = self._dispatch
+
+        obj = self.obj
+        for fn, weak, nargs in dispatch:
+            if weak:
+                fn = fn()
+                if fn is None:
+                    continue
+            if nargs == 0:
                 fn()
-            elif params:
-                fn(self.obj, params)
+            elif params and nargs == 2:
+                fn(obj, params)
             else:
-                fn(self.obj)
+                fn(obj)
@@ -48,10 +48,10 @@ setup(
         # 'Programming Language :: Python :: 2.6',
         # 'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.3',
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
     ],
+    python_requires='>=3.7',
     test_suite='tests',
     tests_require=test_requirements,
     setup_requires=setup_requirements,
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+from sessionlib import (Session, Admission, AdmissionError,
+                        admission_priority)
+from contextlib import contextmanager
+
+
+def limited(limit, **options):
+    class LimitedSession(Session):
+        admission = Admission(limit, **options)
+    return LimitedSession
+
+
+def test_limit():
+    LimitedSession = limited(2, timeout=0)
+    s1, s2 = LimitedSession().open(), LimitedSession().open()
+
+    # Re-entries and forks don't take a slot.
+    s1.open()
+    s1.fork().open().close()
+    s1.close()
+
+    with pytest.raises(AdmissionError):
+        LimitedSession().open()
+    assert Session.current() is s2
+
+    s2.close()
+    with LimitedSession():
+        pass
+    s1.close()
+    assert LimitedSession.admission.stats['active'] == 0
+    assert LimitedSession.admission.stats['rejected'] == 1
+
+
+def test_failed_open_releases():
+    LimitedSession = limited(1, timeout=0)
+
+    @contextmanager
+    def broken():
+        raise ConnectionError()
+        yield
+
+    with pytest.raises(ConnectionError):
+        LimitedSession(broken()).open()
+    with LimitedSession():
+        pass
+
+
+def test_queue_and_priorities():
+    LimitedSession = limited(1, timeout=5)
+    holder = LimitedSession().open()
+    admitted = []
+
+    def waiter(name, priority):
+        with admission_priority(priority):
+            with LimitedSession():
+                admitted.append(name)
+
+    threads = []
+    for name, priority in (('low', 0), ('normal', 1), ('critical', 5),
+                           ('normal 2', 1)):
+        thread = threading.Thread(target=waiter, args=(name, priority))
+        thread.start()
+        threads.append(thread)
+        while LimitedSession.admission.stats['queued'] < len(threads):
+            time.sleep(0.001)
+
+    assert LimitedSession.admission.stats['lanes'] == {0: 1, 1: 2, 5: 1}
+    holder.close()
+    for thread in threads:
+        thread.join(5)
+    assert admitted == ['critical', 'normal', 'normal 2', 'low']
+    assert LimitedSession.admission.stats['wait']['count'] == 4
+
+
+def test_timeout_and_max_queue():
+    LimitedSession = limited(1, timeout=0.02, max_queue=1)
+    holder = LimitedSession().open()
+    errors = []
+
+    def waiter():
+        try:
+            LimitedSession().open()
+        except AdmissionError as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=waiter)
+    thread.start()
+    while not LimitedSession.admission.stats['queued']:
+        time.sleep(0.001)
+    with pytest.raises(AdmissionError):
+        LimitedSession().open()
+    thread.join(1)
+
+    # The session deadline caps the wait too.
+    LimitedSession.admission.timeout = None
+    start = time.monotonic()
+    with pytest.raises(AdmissionError):
+        Session(timeout=0.02).open()
+        try:
+            LimitedSession().open()
+        finally:
+            Session.current().close()
+    assert time.monotonic() - start < 1
+
+    holder.close()
+    stats = LimitedSession.admission.stats
+    assert len(errors) == 1
+    assert (stats['rejected'], stats['timeouts'], stats['active']) == (1, 2, 0)
+
+
+def test_async_waits():
+    LimitedSession = limited(1, timeout=5)
+    log = []
+
+    async def user(name, hold):
+        async with LimitedSession():
+            log.append(name)
+            await asyncio.sleep(hold)
+
+    async def ticker():
+        # Keeps running while the others wait for a slot.
+        for _ in range(3):
+            log.append('tick')
+            await asyncio.sleep(0.01)
+
+    async def main():
+        await asyncio.gather(user('a', 0.05), user('b', 0), ticker())
+
+        # A cancelled waiter leaves the queue.
+        holder = await LimitedSession().aopen()
+        task = asyncio.ensure_future(LimitedSession().aopen())
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert LimitedSession.admission.stats['queued'] == 0
+        await holder.aclose()
+
+    asyncio.run(main())
+    assert log[:2] == ['a', 'tick'] and log.index('b') > 2
+    assert LimitedSession.admission.stats['active'] == 0
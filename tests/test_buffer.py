@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+
+import pytest
+
+from sessionlib import Session, SessionPool, WriteBuffer, FlushError
+from contextlib import contextmanager
+
+
+class AuditSession(Session):
+    def __init__(self, log, **options):
+        super().__init__()
+        self.log = log
+        self.options = options
+
+    def write_buffer(self):
+        buffer = WriteBuffer(**self.options)
+        buffer.register('audit', lambda ops: self.log.append(('audit', ops)))
+        return buffer
+
+    def enter_contexts(self):
+        yield self.connection()
+
+    @contextmanager
+    def connection(self):
+        yield
+        self.log.append('disconnected')
+
+
+def test_flush_on_close():
+    log = []
+    with AuditSession(log) as s:
+        s.defer('user:1', 'v1', target='audit')
+        s.defer('user:2', 'v1', target='audit')
+        s.defer('user:1', 'v2', target='audit')
+        s.defer('cache', lambda: log.append('invalidated'))
+        with s:
+            s.defer('user:3', 'v1', target='audit')
+        assert log == []
+
+    assert log == [('audit', ['v1', 'v2', 'v1']), 'invalidated',
+                   'disconnected']
+
+
+def test_thresholds_and_explicit_flush():
+    log = []
+    with AuditSession(log, max_size=2) as s:
+        s.defer(1, 'a', target='audit')
+        assert log == []
+        s.defer(2, 'b', target='audit')
+        assert log == [('audit', ['a', 'b'])]
+        s.defer(3, 'c', target='audit')
+        s.flush()
+        assert log[-1] == ('audit', ['c'])
+        assert s.buffer.flushes == 2
+
+    log = []
+    with AuditSession(log, max_age=0.01) as s:
+        s.defer(1, 'a', target='audit')
+        time.sleep(0.02)
+        s.defer(2, 'b', target='audit')
+        assert log == [('audit', ['a', 'b'])]
+
+
+def test_discard_on_error():
+    log = []
+    with pytest.raises(KeyError):
+        with AuditSession(log) as s:
+            s.defer(1, 'a', target='audit')
+            raise KeyError()
+    assert log == ['disconnected']
+
+    with SessionPool(lambda: AuditSession(log), max_size=1) as pool:
+        with pytest.raises(KeyError):
+            with pool.session() as s:
+                s.defer(1, 'a', target='audit')
+                raise KeyError()
+        with pool.session() as s:
+            s.defer(2, 'b', target='audit')
+        assert log == ['disconnected', ('audit', ['b'])]
+
+
+def test_error_policies():
+    def fail(ops):
+        raise ValueError(ops)
+
+    log = []
+    buffer = WriteBuffer()
+    buffer.register('bad', fail)
+    buffer.defer(1, 'x', target='bad')
+    buffer.defer(1, lambda: log.append('ok'))
+    with pytest.raises(FlushError) as error:
+        buffer.flush()
+    assert error.value.errors[0][0] == 'bad'
+    assert log == ['ok']
+    assert len(buffer) == 0
+
+    failures = []
+    buffer = WriteBuffer(on_error=lambda *args: failures.append(args[:2]))
+    buffer.register('bad', fail)
+    buffer.defer(1, 'x', target='bad')
+    buffer.flush()
+    assert failures == [('bad', ['x'])]
+
+    buffer = WriteBuffer(on_error='log')
+    buffer.register('bad', fail)
+    buffer.defer(1, 'x', target='bad')
+    buffer.flush()
+
+
+def test_pooled_release_flushes():
+    log = []
+    with SessionPool(lambda: AuditSession(log), max_size=1) as pool:
+        s = pool.acquire()
+        s.defer(1, 'a', target='audit')
+        pool.release(s)
+        assert log == [('audit', ['a'])]
+
+        s = pool.acquire()
+        assert len(s.buffer) == 0
+        pool.release(s)
+
+
+def test_failed_flush_still_closes():
+    def fail(ops):
+        raise ValueError(ops)
+
+    log = []
+    s = AuditSession(log)
+    s.buffer.register('bad', fail)
+    s.on_close.subscribe(lambda: log.append('on_close'))
+    with pytest.raises(FlushError):
+        with s:
+            s.defer(1, 'x', target='bad')
+    assert log == ['on_close', 'disconnected']
+    assert s.depth == 0
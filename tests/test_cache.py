@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+
+import pytest
+
+from sessionlib import Session, SessionlessError, session_cached
+
+
+def test_session_cached():
+    calls = []
+
+    @session_cached
+    def lookup(session, key, scale=1):
+        assert session.current_function.__name__ == 'lookup'
+        calls.append(key)
+        return key * scale
+
+    with pytest.raises(SessionlessError):
+        lookup(1)
+
+    with Session() as s:
+        assert lookup(2) == 2
+        assert lookup(2) == 2
+        assert lookup(2, scale=3) == 6
+        assert lookup(s, 2) == 2
+        assert calls == [2, 2]
+        assert lookup.cache_info(s) == {'hits': 2, 'misses': 2,
+                                        'size': 2, 'maxsize': 128}
+
+        with Session():
+            assert lookup(2) == 2
+            assert calls == [2, 2, 2]
+
+        assert lookup.invalidate(2)
+        assert not lookup.invalidate(2)
+        lookup(2)
+        assert calls == [2, 2, 2, 2]
+
+        lookup.cache_clear()
+        assert lookup.cache_info(s)['size'] == 0
+
+    assert lookup.cache_info(s)['size'] == 0
+    assert lookup.cache_info() == {'hits': 2, 'misses': 4}
+
+    with s:
+        lookup(2)
+        assert calls == [2, 2, 2, 2, 2]
+
+
+def test_lru_and_ttl():
+    calls = []
+
+    @session_cached(maxsize=2, ttl=0.05)
+    def lookup(session, key):
+        calls.append(key)
+        return key
+
+    with Session():
+        lookup(1)
+        lookup(2)
+        lookup(1)
+        lookup(3)
+        lookup(1)
+        lookup(2)
+        assert calls == [1, 2, 3, 2]
+
+        time.sleep(0.06)
+        lookup(2)
+        assert calls == [1, 2, 3, 2, 2]
+
+
+def test_generators():
+    with pytest.raises(TypeError):
+        @session_cached
+        def rejected(session):
+            yield 1
+
+    @session_cached
+    def returns_generator(session):
+        return (i for i in range(3))
+
+    @session_cached(materialize=True)
+    def materialized(session, n):
+        yield from range(n)
+
+    with Session():
+        with pytest.raises(TypeError):
+            returns_generator()
+        assert materialized(3) == (0, 1, 2)
+        assert materialized(3) == (0, 1, 2)
+        assert materialized.cache_info() == {'hits': 1, 'misses': 1}
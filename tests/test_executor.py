@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+import time
+
+import pytest
+
+from sessionlib import (Session, SessionExecutor, SessionProcessPoolExecutor,
+                        SessionlessError, sessionaware)
+from contextlib import contextmanager
+
+
+@sessionaware
+def aware_func(session, delay):
+    assert session.current_function.__name__ == 'aware_func'
+    time.sleep(delay)
+    assert session.current_function.__name__ == 'aware_func'
+    return session, threading.get_ident()
+
+
+def test_session_propagation():
+    with SessionExecutor(4) as executor:
+        with pytest.raises(SessionlessError):
+            executor.submit(aware_func, 0)
+
+        with Session() as s:
+            futures = [executor.submit(aware_func, 0.01 * (i % 3))
+                       for i in range(12)]
+            results = [f.result() for f in futures]
+            assert all(session is s for session, _ in results)
+            assert len({ident for _, ident in results}) > 1
+            assert s.current_function == None
+
+            assert [r[0] for r in executor.map(aware_func, [0] * 3)] == [s] * 3
+
+
+def test_explicit_session():
+    s = Session()
+    with s:
+        with Session():
+            with SessionExecutor(2, session=s) as executor:
+                assert executor.submit(Session.current).result() is s
+
+
+def test_close_waits_for_tasks():
+    events = []
+
+    @contextmanager
+    def resource():
+        yield
+        events.append('closed')
+
+    def task():
+        time.sleep(0.05)
+        events.append('task')
+
+    with SessionExecutor(2) as executor:
+        with Session(resource()):
+            executor.submit(task)
+    assert events == ['task', 'closed']
+
+
+class RecipeSession(Session):
+    opened_here = 0
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+
+    def recipe(self):
+        return type(self), (self.path,), {}
+
+    def enter_contexts(self):
+        RecipeSession.opened_here += 1
+        yield self.log()
+
+    @contextmanager
+    def log(self):
+        yield
+        with open(self.path, 'a') as f:
+            f.write('closed\n')
+
+
+@sessionaware
+def worker_func(session, value):
+    return os.getpid(), session.path, RecipeSession.opened_here, value * 2
+
+
+def test_process_pool(tmp_path):
+    path = str(tmp_path / 'log')
+
+    with pytest.raises(TypeError):
+        Session(contextmanager(lambda: iter([None]))()).recipe()
+
+    with RecipeSession(path) as s:
+        with SessionProcessPoolExecutor(2) as executor:
+            results = list(executor.map(worker_func, range(20)))
+            # Workers that never got a task still open (and close) a session.
+            started = len(executor._processes)
+
+    assert [r[3] for r in results] == [i * 2 for i in range(20)]
+    assert all(r[1] == path for r in results)
+    # One open per worker, however many tasks it ran.
+    assert len({r[2] for r in results}) == 1
+
+    with open(path) as f:
+        assert f.read().count('closed') == started + 1
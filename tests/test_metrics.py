@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncio
+
+import pytest
+
+from sessionlib import Session, sessionaware, metrics
+from contextlib import contextmanager
+
+
+@pytest.fixture
+def recorder():
+    yield metrics.enable()
+    metrics.disable()
+
+
+@contextmanager
+def resource():
+    yield 'resource'
+
+
+class SampleSession(Session):
+    def enter_contexts(self):
+        yield resource()
+
+
+def test_disabled():
+    assert metrics.snapshot() is None
+    assert SampleSession.metrics() is None
+    with SampleSession():
+        pass
+    assert metrics.snapshot() is None
+
+
+def test_session_metrics(recorder):
+    with SampleSession() as s:
+        with s:
+            pass
+    with SampleSession():
+        pass
+
+    stats = SampleSession.metrics()
+    assert stats['open']['count'] == 2
+    assert stats['close']['count'] == 2
+    assert stats['held']['count'] == 2
+    assert stats['reentries'] == 1
+
+    context = stats['contexts']['tests.test_metrics.resource']
+    assert context['enter']['count'] == context['exit']['count'] == 2
+    assert Session.metrics()['open']['count'] == 0
+
+    snapshot = metrics.snapshot()
+    assert snapshot['sessions']['tests.test_metrics.SampleSession'] == stats
+
+
+def test_function_metrics(recorder):
+    @sessionaware
+    def func(session):
+        return session
+
+    @sessionaware
+    def gen(session):
+        yield from range(3)
+
+    @sessionaware
+    async def coro(session):
+        await asyncio.sleep(0)
+
+    async def main():
+        with Session():
+            await coro()
+
+    with Session():
+        for _ in range(5):
+            func()
+        assert list(gen()) == [0, 1, 2]
+        g = gen()
+        next(g)
+        g.close()
+    asyncio.run(main())
+
+    functions = metrics.snapshot()['functions']
+    name = 'tests.test_metrics.test_function_metrics.<locals>.{}'
+    assert functions[name.format('func')]['count'] == 5
+    assert functions[name.format('gen')]['count'] == 2
+    assert functions[name.format('coro')]['count'] == 1
+
+    histogram = functions[name.format('func')]
+    assert histogram['min'] <= histogram['p50'] <= histogram['max']
+    assert sum(histogram['buckets'].values()) == 5
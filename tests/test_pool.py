@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+import pytest
+
+from sessionlib import Session, SessionPool, PoolTimeoutError, PoolClosedError
+from contextlib import contextmanager
+
+
+class CountingSession(Session):
+    entered = 0
+    exited = 0
+
+    def enter_contexts(self):
+        yield self.resource()
+
+    @contextmanager
+    def resource(self):
+        CountingSession.entered += 1
+        yield
+        CountingSession.exited += 1
+
+
+@pytest.fixture(autouse=True)
+def reset_counters():
+    CountingSession.entered = CountingSession.exited = 0
+
+
+def test_prewarm_and_reuse():
+    with SessionPool(CountingSession, min_size=2, max_size=2) as pool:
+        assert CountingSession.entered == 2
+        assert Session.current() == None
+
+        for _ in range(10):
+            with pool.session() as s:
+                assert Session.current() == s
+                assert s.depth == 2
+            assert Session.current() == None
+
+        assert CountingSession.entered == 2
+        assert pool.stats['hits'] == 10
+        assert pool.stats['misses'] == 0
+
+    assert CountingSession.exited == 2
+    with pytest.raises(PoolClosedError):
+        pool.acquire()
+
+
+def test_reset_subscribers():
+    with SessionPool(CountingSession, max_size=1) as pool:
+        calls = []
+        with pool.session() as s:
+            s.on_leave.subscribe(lambda: calls.append('leave'))
+        with pool.session() as s2:
+            assert s2 is s
+        assert calls == ['leave']
+
+
+def test_blocking_timeout():
+    with SessionPool(CountingSession, max_size=1) as pool:
+        s = pool.acquire()
+        with pytest.raises(PoolTimeoutError):
+            pool.acquire(timeout=0.01)
+
+        threading.Timer(0.02, pool.release, (s,)).start()
+        assert pool.acquire(timeout=1) is s
+
+        stats = pool.stats
+        assert stats['timeouts'] == 1
+        assert stats['waits'] == 2
+        assert stats['wait_time'] > 0
+
+
+def test_recycling_and_health_check():
+    healthy = [True]
+    pool = SessionPool(CountingSession, min_size=1, max_size=1,
+                       idle_timeout=0.01,
+                       health_check=lambda s: healthy[0])
+
+    time.sleep(0.02)
+    assert pool.evict() == 1
+    assert pool.stats['size'] == 1
+    assert CountingSession.entered == 2
+
+    pool.idle_timeout = None
+    healthy[0] = False
+    s = pool.acquire()
+    healthy[0] = True
+    pool.release(s)
+    assert CountingSession.exited == 2
+
+    pool.max_lifetime = 0
+    s2 = pool.acquire()
+    assert s2 is not s
+    pool.close()
+    assert pool.stats['size'] == 1
+    pool.release(s2)
+    assert pool.stats['size'] == 0
+    assert CountingSession.entered == CountingSession.exited
+
+
+def test_failing_health_check():
+    def health_check(session):
+        raise ConnectionError('gone')
+
+    with SessionPool(CountingSession, min_size=1, max_size=1,
+                     health_check=health_check) as pool:
+        for _ in range(3):
+            s = pool.acquire(timeout=1)
+            pool.release(s)
+
+        assert pool.stats['size'] == 1
+        assert pool.stats['discarded'] == 3
+        assert CountingSession.exited == 3
+
+
+def test_failing_prewarm():
+    failures = [1]
+
+    def factory():
+        if failures:
+            failures.pop()
+            raise ConnectionError()
+        return CountingSession()
+
+    pool = SessionPool(factory, max_size=3)
+    pool.min_size = 3
+    with pytest.raises(ConnectionError):
+        pool.evict()
+    assert pool.stats['size'] == 0
+
+    pool.evict()
+    assert pool.stats['size'] == pool.stats['idle'] == 3
+    sessions = [pool.acquire(timeout=1) for _ in range(3)]
+    for s in sessions:
+        pool.release(s)
+    pool.close()
+
+
+def test_deadline_per_checkout():
+    with SessionPool(lambda: Session(timeout=0.05), max_size=1) as pool:
+        for _ in range(3):
+            with pool.session() as s:
+                s.check_deadline()
+                assert 0.03 < s.remaining() <= 0.05
+                time.sleep(0.06)
+                assert s.remaining() == 0
+        assert pool.stats['created'] == 1
+
+
+def test_threaded_checkout():
+    pool = SessionPool(CountingSession, max_size=3)
+    errors = []
+
+    def worker():
+        try:
+            for _ in range(50):
+                with pool.session(timeout=5) as s:
+                    assert Session.current() == s
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert not errors
+    assert CountingSession.entered <= 3
+    stats = pool.stats
+    assert stats['hits'] + stats['misses'] == 400
+    pool.close()
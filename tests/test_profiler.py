@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import threading
+
+from sessionlib import Session, sessionaware, Profiler
+
+
+class AppSession(Session):
+    pass
+
+
+class OtherSession(Session):
+    pass
+
+
+blocked = threading.Semaphore(0)
+release = threading.Semaphore(0)
+
+
+@sessionaware
+def handler(session):
+    inner()
+    with OtherSession():
+        return list(rows())
+
+
+@sessionaware
+def inner(session):
+    blocked.release()
+    release.acquire(timeout=5)
+
+
+@sessionaware
+def rows(session):
+    yield 1
+    inner()
+
+
+def serve():
+    with AppSession():
+        handler()
+
+
+def test_sample():
+    name = '{}.'.format(__name__)
+    profiler = Profiler()
+    thread = threading.Thread(target=serve, name='worker')
+    thread.start()
+
+    # Blocked in inner(), first called directly, then from the generator
+    # under a nested session.
+    for _ in range(2):
+        blocked.acquire(timeout=5)
+        profiler.sample()
+        release.release()
+    thread.join(5)
+
+    assert profiler.collapsed().splitlines() == [
+        'worker;AppSession;{0}handler;OtherSession;{0}rows;{0}inner 1'
+        .format(name),
+        'worker;AppSession;{0}handler;{0}inner 1'.format(name),
+    ]
+    assert profiler.stats['samples'] == 2
+
+
+def test_suspended_generator():
+    profiler = Profiler(threads=False)
+    suspended = threading.Event()
+    done = threading.Event()
+
+    def consume():
+        with OtherSession():
+            iterator = rows()
+            next(iterator)
+            suspended.set()
+            done.wait(5)
+
+    # While the consumer holds a suspended rows() there's nothing to record.
+    thread = threading.Thread(target=consume)
+    thread.start()
+    suspended.wait(5)
+    profiler.sample()
+    done.set()
+    thread.join(5)
+    assert profiler.stats['samples'] == 1
+    assert profiler.collapsed() == ''
+
+
+def test_start_stop():
+    profiler = Profiler(interval=0.001)
+    with profiler:
+        assert profiler.running
+        with AppSession():
+            threading.Event().wait(0.05)
+    assert not profiler.running
+    assert profiler.stats['samples'] > 0
+    # The sampling thread and idle threads are never recorded.
+    assert profiler.collapsed() == ''
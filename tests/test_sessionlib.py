@@ -1,10 +1,17 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import asyncio
+import sys
+import threading
+import time
+
 import pytest
 
-from sessionlib import Session, sessionaware, SessionlessError
-from contextlib import contextmanager
+from sessionlib import (Session, sessionaware, lazycontext, parallel,
+                        retrying, metrics, SessionlessError, DeadlineExceeded)
+from contextlib import contextmanager, asynccontextmanager, nullcontext
+from contextvars import copy_context
 
 
 def test_session_stack():
@@ -235,3 +242,1098 @@ def test_gen_function_next():
     with Session() as s:
         aware_func()
         assert s.current_function == None
+
+
+def test_session_stack_thread_isolation():
+
+    barrier = threading.Barrier(4)
+    errors = []
+
+    def worker():
+        try:
+            assert Session.current() == None
+            with Session() as s1:
+                barrier.wait()
+                assert Session.current() == s1
+                with Session() as s2:
+                    barrier.wait()
+                    assert Session.current() == s2
+                assert Session.current() == s1
+            assert Session.current() == None
+        except Exception as e:
+            errors.append(e)
+
+    with Session() as main:
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert Session.current() == main
+
+    assert not errors
+
+
+def test_session_stack_task_isolation():
+
+    async def task(parent):
+        assert Session.current() == parent
+        with Session() as s:
+            await asyncio.sleep(0)
+            assert Session.current() == s
+        assert Session.current() == parent
+
+    async def main():
+        with Session() as s:
+            await asyncio.gather(*(task(s) for _ in range(4)))
+            assert Session.current() == s
+
+    asyncio.run(main())
+
+
+def test_reentry_depth():
+    s = Session()
+    assert not s.opened and s.depth == 0
+
+    for i in range(1, 101):
+        s.open()
+        assert s.depth == i
+
+    for i in reversed(range(100)):
+        s.close()
+        assert s.depth == i
+        assert Session.current() == (s if i else None)
+
+    assert not s.opened
+
+    # Closing it again is refused without touching its state.
+    with pytest.raises(SessionlessError):
+        s.close()
+    assert s.depth == 0
+    with s:
+        assert s.opened and s.depth == 1
+
+
+def test_async_session():
+
+    events = []
+
+    @asynccontextmanager
+    async def acmanager(name):
+        events.append('enter ' + name)
+        yield name
+        events.append('exit ' + name)
+
+    @contextmanager
+    def cmanager(name):
+        yield name
+
+    class SampleSession(Session):
+        async def enter_contexts(self):
+            self.a = yield acmanager('a')
+            await asyncio.sleep(0)
+            self.b = yield cmanager('b')
+
+    class SampleSession2(Session):
+        def enter_contexts(self):
+            self.a = yield acmanager('a')
+
+    async def main():
+        async with SampleSession() as s:
+            assert Session.current() == s
+            assert (s.a, s.b) == ('a', 'b')
+            async with s:
+                assert s.depth == 2
+        assert Session.current() == None
+
+        async with SampleSession2() as s:
+            assert s.a == 'a'
+            with pytest.raises(RuntimeError):
+                s.close()
+
+    asyncio.run(main())
+    assert events == ['enter a', 'exit a', 'enter a', 'exit a']
+
+
+def test_async_sessionaware():
+
+    @sessionaware
+    async def aware_coro(session, delay):
+        assert session.current_function.__name__ == 'aware_coro'
+        await asyncio.sleep(delay)
+        assert session.current_function.__name__ == 'aware_coro'
+        return session
+
+    @sessionaware
+    async def aware_agen(session):
+        for i in range(3):
+            assert session.current_function.__name__ == 'aware_agen'
+            await asyncio.sleep(0)
+            yield i
+
+    @sessionaware
+    async def outer(session):
+        assert session.current_function.__name__ == 'outer'
+        items = [i async for i in aware_agen()]
+        assert session.current_function.__name__ == 'outer'
+        return items
+
+    async def main():
+        with pytest.raises(SessionlessError):
+            await aware_coro(0)
+
+        async with Session() as s:
+            results = await asyncio.gather(
+                aware_coro(0.01), aware_coro(0), outer())
+            assert results == [s, s, [0, 1, 2]]
+            assert s.current_function == None
+
+            s2 = Session()
+            assert await aware_coro(s2, 0) == s2
+            assert not s2.opened
+
+    asyncio.run(main())
+
+
+def test_bind():
+
+    @sessionaware
+    def aware_func(session, value):
+        assert session.current_function.__name__ == 'aware_func'
+        assert Session.current() == session
+        return value
+
+    @sessionaware
+    def gen_func(session, n):
+        for i in range(n):
+            assert session.current_function.__name__ == 'gen_func'
+            yield i
+
+    def plain_func(session):
+        assert session.current_function.__name__ == 'plain_func'
+        return session
+
+    @sessionaware
+    async def aware_coro(session):
+        await asyncio.sleep(0)
+        assert session.current_function.__name__ == 'aware_coro'
+        return session
+
+    s = Session()
+    bound = s.bind(aware_func)
+    with pytest.raises(SessionlessError):
+        bound(1)
+
+    calls = []
+    s.on_enter.subscribe(lambda: calls.append('enter'))
+
+    with s:
+        with Session() as s2:
+            assert bound(1) == 1
+            assert list(s.bind(gen_func)(3)) == [0, 1, 2]
+            assert s.bind(plain_func)() == s
+            assert asyncio.run(s.bind(aware_coro)()) == s
+            assert Session.current() == s2
+        assert bound(2) == 2
+
+    assert calls == []
+
+
+def test_lazy_contexts():
+
+    events = []
+
+    @contextmanager
+    def cmanager(name):
+        events.append('enter ' + name)
+        yield name
+        events.append('exit ' + name)
+
+    class SampleSession(Session):
+        @lazycontext
+        def db(self):
+            return cmanager('db')
+
+        @lazycontext
+        def cache(self):
+            return cmanager('cache')
+
+        @lazycontext
+        def queue(self):
+            return cmanager('queue')
+
+    assert SampleSession.lazy_contexts() == ('cache', 'db', 'queue')
+
+    s = SampleSession()
+    with pytest.raises(SessionlessError):
+        s.db
+
+    with s:
+        assert events == []
+        assert s.cache == 'cache'
+        assert s.db == 'db'
+        assert s.db == 'db'
+        assert s.materialized == ('cache', 'db')
+
+    assert events == ['enter cache', 'enter db', 'exit db', 'exit cache']
+    assert s.materialized == ()
+
+    with s:
+        assert s.queue == 'queue'
+        assert s.materialized == ('queue',)
+        with s.fork() as child:
+            assert child.queue == 'queue'
+            assert child.materialized == ()
+
+
+def test_lazy_contexts_concurrency():
+
+    @contextmanager
+    def slow(value):
+        time.sleep(0.1)
+        yield value
+
+    class SlottedSession(Session):
+        __slots__ = ()
+
+        @lazycontext
+        def db(self):
+            return slow(self.cache + 1)
+
+        @lazycontext
+        def cache(self):
+            return slow(1)
+
+    results = []
+
+    def worker():
+        with SlottedSession() as s:
+            results.append(s.db)
+
+    # Independent sessions materialize at the same time.
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    start = time.monotonic()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == [2] * 4
+    assert time.monotonic() - start < 0.4
+
+    # Within a session the first access wins.
+    with SlottedSession() as s:
+        threads = [threading.Thread(target=lambda: results.append(s.cache))
+                   for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert s.materialized == ('cache',)
+
+
+def test_parallel_contexts():
+
+    events = []
+    barrier = threading.Barrier(3, timeout=1)
+
+    @contextmanager
+    def cmanager(name, fail=False):
+        # Only completes if all three contexts are entering at once.
+        barrier.wait()
+        if fail:
+            raise ValueError(name)
+        events.append('enter ' + name)
+        yield name
+        events.append('exit ' + name)
+
+    class SampleSession(Session):
+        def enter_contexts(self):
+            values = yield parallel(cmanager('db'), cmanager('cache'),
+                                    cmanager('queue'))
+            assert values == ('db', 'cache', 'queue')
+            assert Session.current() == self
+
+    with SampleSession():
+        assert sorted(events) == ['enter cache', 'enter db', 'enter queue']
+    assert events[3:] == ['exit queue', 'exit cache', 'exit db']
+
+    del events[:]
+    barrier.reset()
+
+    class FailingSession(Session):
+        def enter_contexts(self):
+            yield parallel(cmanager('db'), cmanager('cache', fail=True),
+                           cmanager('queue'))
+
+    with pytest.raises(ValueError):
+        copy_context().run(FailingSession().open)
+    assert sorted(events) == ['enter db', 'enter queue',
+                              'exit db', 'exit queue']
+
+
+def test_async_parallel_contexts():
+
+    active = []
+    peak = []
+
+    @asynccontextmanager
+    async def acmanager(name):
+        active.append(name)
+        await asyncio.sleep(0.01)
+        peak.append(len(active))
+        yield name
+        active.remove(name)
+
+    @contextmanager
+    def cmanager(name):
+        yield name
+
+    class SampleSession(Session):
+        def enter_contexts(self):
+            self.values = yield parallel(acmanager('db'), acmanager('cache'),
+                                         cmanager('queue'))
+
+    async def main():
+        async with SampleSession() as s:
+            assert s.values == ('db', 'cache', 'queue')
+            assert max(peak) == 2
+        assert active == []
+
+    asyncio.run(main())
+
+
+def test_generator_send_throw_close():
+    events = []
+
+    @sessionaware
+    def coroutine(session):
+        total = 0
+        try:
+            while True:
+                try:
+                    value = yield total
+                except ValueError:
+                    assert session.current_function.__name__ == 'coroutine'
+                    events.append('handled')
+                    continue
+                if value is None:
+                    return total
+                total += value
+        finally:
+            assert session.current_function.__name__ == 'coroutine'
+            events.append('finally')
+
+    @sessionaware
+    def delegate(session):
+        result = yield from coroutine()
+        events.append(('result', result))
+
+    with Session() as s:
+        g = coroutine()
+        assert next(g) == 0
+        assert g.send(2) == 2
+        assert g.send(3) == 5
+        assert g.throw(ValueError()) == 5
+        assert s.current_function == None
+        with pytest.raises(StopIteration) as stop:
+            g.send(None)
+        assert stop.value.value == 5
+
+        g = coroutine()
+        next(g)
+        g.close()
+        assert s.current_function == None
+
+        g = delegate()
+        next(g)
+        g.send(1)
+        with pytest.raises(StopIteration):
+            next(g)
+
+        g = coroutine()
+        next(g)
+        with pytest.raises(KeyError):
+            g.throw(KeyError())
+
+    assert events == ['handled', 'finally', 'finally', 'finally',
+                      ('result', 1), 'finally']
+
+
+def test_batched_generators():
+
+    @sessionaware(batch=4)
+    def rows(session, n):
+        for i in range(n):
+            assert session.current_function.__name__ == 'rows'
+            yield i
+
+    @sessionaware(batch=2)
+    async def arows(session, n):
+        for i in range(n):
+            assert session.current_function.__name__ == 'arows'
+            await asyncio.sleep(0)
+            yield i
+
+    with pytest.raises(ValueError):
+        sessionaware(batch=0)
+
+    async def collect():
+        return [chunk async for chunk in arows(5)]
+
+    with Session() as s:
+        assert list(rows(10)) == [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]]
+        assert list(rows(8)) == [[0, 1, 2, 3], [4, 5, 6, 7]]
+        assert list(rows(0)) == []
+        for chunk in rows(6):
+            assert s.current_function == None
+        assert asyncio.run(collect()) == [[0, 1], [2, 3], [4]]
+
+    # Items read before an error are delivered ahead of it.
+    @sessionaware(batch=10)
+    def failing(session, n):
+        yield from range(n)
+        raise ValueError(n)
+
+    @sessionaware(batch=10)
+    async def afailing(session, n):
+        for i in range(n):
+            yield i
+        raise ValueError(n)
+
+    async def acollect(chunks):
+        with pytest.raises(ValueError):
+            async for chunk in afailing(5):
+                chunks.append(chunk)
+        return chunks
+
+    with Session():
+        chunks = []
+        with pytest.raises(ValueError):
+            for chunk in failing(15):
+                chunks.append(chunk)
+        assert chunks == [list(range(10)), list(range(10, 15))]
+        assert asyncio.run(acollect([])) == [[0, 1, 2, 3, 4]]
+
+
+def test_compact_layout():
+    s = Session()
+    assert not hasattr(s, '__dict__')
+    with s:
+        pass
+    assert s._on_open is None and s._on_close is None
+
+    class SampleSession(Session):
+        def __init__(self, name):
+            self.name = name
+
+    with SampleSession('sample') as s:
+        assert s.name == 'sample'
+        assert s.depth == 1
+
+
+def test_map():
+
+    events = []
+
+    @sessionaware
+    def aware_func(session, a, b=0):
+        assert Session.current() == session
+        assert session.current_function.__name__ == 'aware_func'
+        return a + b
+
+    s = Session()
+    s.on_open.subscribe(lambda: events.append('open'))
+    s.on_enter.subscribe(lambda: events.append('enter'))
+    s.on_close.subscribe(lambda: events.append('close'))
+
+    results = s.map(aware_func, range(5), range(5))
+    assert events == []
+    assert list(results) == [0, 2, 4, 6, 8]
+    assert events == ['open', 'close']
+
+    with s:
+        with Session() as other:
+            assert list(s.starmap(aware_func, [(1, 2), (3,)])) == [3, 3]
+            assert Session.current() == other
+            assert s.current_function == None
+    assert events == ['open', 'close', 'open', 'enter', 'close']
+
+    it = s.map(aware_func, range(10))
+    next(it)
+    assert s.opened
+    it.close()
+    assert not s.opened
+
+    idents = set()
+
+    def threaded(session, i):
+        idents.add(threading.get_ident())
+        assert session.current_function.__name__ == 'threaded'
+        return i * i
+
+    results = s.map(threaded, range(100), chunksize=7, max_workers=4)
+    assert list(results) == [i * i for i in range(100)]
+    assert len(idents) > 1
+    assert not s.opened
+
+    # Closing early cancels the chunks that haven't started.
+    ran = []
+
+    def slow(session, i):
+        time.sleep(0.05 if i else 0)
+        ran.append(i)
+        return i
+
+    results = s.map(slow, range(20), max_workers=2)
+    assert next(results) == 0
+    results.close()
+    assert len(ran) <= 3 and not s.opened
+
+    with pytest.raises(ValueError):
+        s.map(aware_func, range(3), chunksize=0)
+
+
+def test_deadlines():
+
+    @sessionaware
+    def aware_func(session):
+        return session.remaining()
+
+    @sessionaware
+    def gen_func(session):
+        for i in range(3):
+            yield i
+            time.sleep(0.06)
+
+    with Session() as s:
+        assert s.deadline is None and aware_func() is None
+
+    with Session(timeout=10) as outer:
+        assert 9 < aware_func() <= 10
+        with Session(timeout=0.05) as inner:
+            assert inner.deadline < outer.deadline
+            with Session(timeout=60) as nested:
+                assert nested.deadline == inner.deadline
+
+            g = gen_func()
+            assert next(g) == 0
+            assert next(g) == 1
+            with pytest.raises(DeadlineExceeded):
+                next(g)
+            with pytest.raises(DeadlineExceeded):
+                aware_func()
+            assert inner.remaining() == 0
+        assert outer.remaining() > 9
+
+    assert inner.deadline is None
+
+
+def test_async_deadlines():
+
+    cancelled = []
+
+    @sessionaware
+    async def slow(session):
+        try:
+            await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            cancelled.append(session.current_function.__name__)
+            raise
+
+    @sessionaware
+    async def outer(session):
+        await asyncio.sleep(0)
+        return await slow()
+
+    @sessionaware
+    async def own_timeout(session):
+        await asyncio.wait_for(asyncio.sleep(1), 0.01)
+
+    async def main():
+        async with Session(timeout=0.05):
+            with pytest.raises(DeadlineExceeded):
+                await outer()
+        async with Session(timeout=10):
+            with pytest.raises(asyncio.TimeoutError) as error:
+                await own_timeout()
+            assert not isinstance(error.value, DeadlineExceeded)
+
+    asyncio.run(main())
+    assert cancelled == ['slow']
+
+
+def test_fork():
+
+    log = []
+
+    class DBSession(Session):
+        def __init__(self, name):
+            super().__init__()
+            self.name = name
+
+        def enter_contexts(self):
+            self.db = yield self.connect()
+
+        @contextmanager
+        def connect(self):
+            log.append('connect')
+            yield object()
+            log.append('disconnect')
+
+    @contextmanager
+    def scratch():
+        log.append('scratch')
+        yield
+        log.append('scratch done')
+
+    @sessionaware(cls=DBSession)
+    def query(session):
+        return session, session.db, session.current_function.__name__
+
+    parent = DBSession('main')
+    with pytest.raises(SessionlessError):
+        parent.fork().open()
+
+    with parent:
+        child = parent.fork(scratch())
+        assert isinstance(child, DBSession) and child.parent is parent
+        child.on_close.subscribe(lambda: log.append('child closed'))
+        assert parent._on_close is None
+
+        with child:
+            assert child.name == 'main' and child.db is parent.db
+            assert query() == (child, parent.db, 'query')
+            assert log == ['connect', 'scratch']
+        assert log[2:] == ['child closed', 'scratch done']
+
+
+    assert log[-1] == 'disconnect'
+
+    # The parent's final close while children are open (from another thread)
+    # leaves it, but its teardown waits for the last of them...
+    context = copy_context()
+    context.run(parent.open)
+    child = parent.fork().open()
+    other = parent.fork().open()
+    closing = context.run(parent.close)
+    assert not parent.opened and not closing.done()
+    assert log[-1] == 'connect' and child.db is parent.db
+    with pytest.raises(SessionlessError):
+        parent.fork().open()
+    with pytest.raises(RuntimeError):
+        parent.open()
+    other.close()
+    assert log[-1] == 'connect'
+    child.close()
+    assert log[-1] == 'disconnect' and closing.done()
+    assert context.run(Session.current) is None
+
+    # ...also for one leaked in the same thread, which doesn't hide the error
+    # leaving the parent.
+    with pytest.raises(KeyError):
+        with parent:
+            child = parent.fork().open()
+            raise KeyError()
+    assert not parent.opened and Session.current() is child
+    assert log[-1] == 'connect'
+    child.close()
+    assert Session.current() is None and log[-1] == 'disconnect'
+
+    # Re-entries can still be left.
+    with parent:
+        with parent.fork():
+            with parent:
+                pass
+
+
+def test_reopened_fork():
+
+    class ConnSession(Session):
+        def __init__(self):
+            super().__init__()
+            self.opens = 0
+
+        def enter_contexts(self):
+            self.opens += 1
+            self.conn = yield nullcontext(self.opens)
+
+    parent = ConnSession()
+    with parent:
+        child = parent.fork()
+        with child:
+            assert child.conn == 1
+
+    # A fork reopened in a later open of its parent doesn't keep the state of
+    # the earlier one.
+    with parent:
+        with child:
+            assert child.conn == 2 and child.opens == 2
+
+
+def test_fork_async_deferred_close():
+    log = []
+
+    @asynccontextmanager
+    async def resource():
+        yield
+        log.append('closed')
+
+    async def main():
+        parent = Session(resource())
+        await parent.aopen()
+        child = parent.fork()
+        await child.aopen()
+        closing = await parent.aclose()
+        assert not parent.opened and log == []
+        await child.aclose()
+        await closing
+        assert log == ['closed']
+
+    asyncio.run(main())
+
+
+def test_transactional_open():
+
+    log = []
+
+    @contextmanager
+    def resource(name, fail=False):
+        if fail:
+            raise ConnectionError(name)
+        log.append(name)
+        try:
+            yield name
+        except ConnectionError:
+            log.append(name + ' rolled back')
+            raise
+
+    class FlakySession(Session):
+        fail = True
+
+        def enter_contexts(self):
+            yield resource('a')
+            yield resource('b')
+            yield resource('c', fail=self.fail)
+
+    metrics.enable()
+    try:
+        outer = Session().open()
+        session = FlakySession(timeout=10)
+        with pytest.raises(ConnectionError):
+            session.open()
+        assert log == ['a', 'b', 'b rolled back', 'a rolled back']
+        assert Session.current() is outer
+        assert session.depth == 0 and session.deadline is None
+
+        async def aopen():
+            with pytest.raises(ConnectionError):
+                await session.aopen()
+            assert Session.current() is outer and session.depth == 0
+
+        asyncio.run(aopen())
+        assert FlakySession.metrics()['rollbacks'] == 2
+
+        session.fail = False
+        with session:
+            assert Session.current() is session
+        outer.close()
+    finally:
+        metrics.disable()
+
+
+def test_retrying():
+
+    attempts = []
+
+    def connect(failures, error=ConnectionError):
+        @contextmanager
+        def connection():
+            attempts.append(len(attempts))
+            if len(attempts) <= failures:
+                raise error('attempt {}'.format(len(attempts)))
+            yield len(attempts)
+        return connection()
+
+    class DBSession(Session):
+        def __init__(self, failures, error=ConnectionError, **policy):
+            super().__init__()
+            policy.setdefault('backoff', 0.001)
+            self.policy = retrying(lambda: connect(failures, error),
+                                   retry_on=ConnectionError, **policy)
+
+        def enter_contexts(self):
+            self.db = yield self.policy
+
+    metrics.enable()
+    try:
+        with DBSession(2) as s:
+            assert s.db == 3
+        assert DBSession.metrics()['retries'] == 2
+
+        del attempts[:]
+        with pytest.raises(ConnectionError):
+            DBSession(5, attempts=3).open()
+        assert len(attempts) == 3
+
+        # Other errors aren't retried.
+        del attempts[:]
+        with pytest.raises(ValueError):
+            DBSession(1, error=ValueError).open()
+        assert len(attempts) == 1
+
+        # Nor are backoffs past the deadline waited out.
+        del attempts[:]
+        session = DBSession(1, backoff=10, jitter=0)
+        session.timeout = 0.5
+        with pytest.raises(ConnectionError):
+            session.open()
+        assert len(attempts) == 1
+        assert Session.current() is None
+
+        async def main():
+            del attempts[:]
+            async with DBSession(1) as s:
+                assert s.db == 2
+
+        asyncio.run(main())
+        assert DBSession.metrics()['retries'] == 5
+        assert DBSession.metrics()['rollbacks'] == 3
+    finally:
+        metrics.disable()
+
+    policy = retrying(None, backoff=1, max_backoff=3, jitter=0)
+    assert [policy.delay(n) for n in (1, 2, 3)] == [1, 2, 3]
+    assert 0 <= retrying(None, jitter=1).delay(5) <= 1.6
+
+
+def test_concurrent_open_close():
+
+    # Final closes racing with reopens (and re-entries) from other threads
+    # must each tear down the exit stack of their own open.
+    session = Session(nullcontext(1), nullcontext(2))
+    errors = []
+
+    def worker():
+        try:
+            for _ in range(3000):
+                with session:
+                    with session:
+                        pass
+        except Exception as e:
+            errors.append(e)
+
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(interval)
+    assert errors == [] and not session.opened
+
+
+def test_reentry_during_open():
+
+    entering = threading.Event()
+    release = threading.Event()
+    failures = [1]
+
+    class SlowSession(Session):
+        def enter_contexts(self):
+            entering.set()
+            release.wait(5)
+            if failures:
+                failures.pop()
+                raise ConnectionError()
+            self.db = yield nullcontext('db')
+            # The opener's own nested entries don't wait.
+            with self:
+                pass
+
+    session = SlowSession()
+    seen = []
+
+    def reenter():
+        with session:
+            seen.append((session.depth, getattr(session, 'db', None)))
+
+    def start(target):
+        thread = threading.Thread(target=target)
+        thread.start()
+        return thread
+
+    def failing_open():
+        with pytest.raises(ConnectionError):
+            session.open()
+
+    # The first open fails: the waiting thread then opens it itself.
+    opener = start(failing_open)
+    assert entering.wait(5)
+    waiter = start(reenter)
+    waiter.join(0.05)
+    assert waiter.is_alive() and seen == []
+    release.set()
+    opener.join(5)
+    waiter.join(5)
+    assert seen == [(1, 'db')] and not session.opened
+
+    # Entries racing with a successful open wait to get its resources.
+    entering.clear()
+    release.clear()
+    done = threading.Event()
+
+    def hold():
+        with session:
+            done.wait(5)
+
+    opener = start(hold)
+    assert entering.wait(5)
+    waiter = start(reenter)
+    waiter.join(0.05)
+    assert waiter.is_alive()
+    release.set()
+    waiter.join(5)
+    assert seen[-1] == (2, 'db')
+    done.set()
+    opener.join(5)
+    assert not session.opened
+
+    # Async entries wait without blocking the event loop.
+    class AsyncSession(Session):
+        async def enter_contexts(self):
+            await asyncio.sleep(0.05)
+            self.db = yield nullcontext('db')
+
+    async def main():
+        session = AsyncSession()
+
+        async def reenter():
+            await asyncio.sleep(0.01)
+            async with session:
+                return session.depth, session.db
+
+        async def hold():
+            async with session:
+                await asyncio.sleep(0.05)
+
+        return await asyncio.gather(reenter(), hold())
+
+    assert asyncio.run(main())[0] == (2, 'db')
+
+
+def test_prefetch():
+
+    produced = []
+    closed = []
+
+    @sessionaware(prefetch=2)
+    def pages(session, count, fail_at=None):
+        try:
+            for i in range(count):
+                if i == fail_at:
+                    raise ValueError(i)
+                produced.append(i)
+                yield (i, Session.current() is session,
+                       session.current_function.__name__,
+                       threading.current_thread().name)
+            return 'done'
+        finally:
+            closed.append(threading.current_thread().name)
+
+    def wait_for(n):
+        deadline = time.monotonic() + 5
+        while len(produced) < n and time.monotonic() < deadline:
+            time.sleep(0.001)
+
+    session = Session()
+    with session:
+        # Read ahead up to the buffer size, with the session and function
+        # frame of a regular step.
+        items = pages(10)
+        assert next(items) == (0, True, 'pages', 'sessionlib-prefetch')
+        wait_for(3)
+        time.sleep(0.01)
+        assert produced == [0, 1, 2]
+
+        # Closing early stops the producer and closes the generator.
+        items.close()
+        assert closed == ['sessionlib-prefetch']
+        assert produced == [0, 1, 2]
+
+        def delegate():
+            return (yield from pages(3))
+
+        result = []
+        gen = delegate()
+        try:
+            while True:
+                result.append(next(gen)[0])
+        except StopIteration as stop:
+            assert stop.value == 'done'
+        assert result == [0, 1, 2]
+
+        # Errors surface after the items produced before them.
+        received = []
+        with pytest.raises(ValueError):
+            for item in pages(5, fail_at=3):
+                received.append(item[0])
+        assert received == [0, 1, 2]
+
+    # An explicit session is made current on the producer too.
+    assert next(pages(session, 1))[1:3] == (True, 'pages')
+
+    @sessionaware(batch=2, prefetch=1)
+    def batched(session):
+        yield from range(5)
+
+    with session:
+        assert list(batched()) == [[0, 1], [2, 3], [4]]
+        with pytest.raises(TypeError):
+            gen = pages(3)
+            next(gen)
+            gen.send(1)
+
+    with pytest.raises(ValueError):
+        sessionaware(prefetch=0)
+
+
+def test_async_prefetch():
+
+    produced = []
+    closed = []
+
+    @sessionaware(prefetch=2)
+    async def pages(session, count, fail_at=None):
+        try:
+            for i in range(count):
+                if i == fail_at:
+                    raise ValueError(i)
+                await asyncio.sleep(0)
+                produced.append(i)
+                yield i, Session.current() is session, \
+                    session.current_function.__name__
+        finally:
+            closed.append(True)
+
+    async def main():
+        async with Session():
+            items = pages(10)
+            assert await items.__anext__() == (0, True, 'pages')
+            for _ in range(10):
+                await asyncio.sleep(0)
+            assert produced == [0, 1, 2]
+            await items.aclose()
+            assert closed == [True] and produced == [0, 1, 2]
+
+            received = []
+            with pytest.raises(ValueError):
+                async for item in pages(5, fail_at=2):
+                    received.append(item[0])
+            assert received == [0, 1]
+
+            assert [i async for i, _, _ in pages(3)] == [0, 1, 2]
+
+    asyncio.run(main())
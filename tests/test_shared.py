@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+import pytest
+
+import sessionlib
+
+from sessionlib import Session, SharedResources, shared_resources
+from contextlib import contextmanager
+
+
+log = []
+
+
+@contextmanager
+def connect(host, port=5432):
+    log.append(('connect', host))
+    yield object()
+    log.append(('close', host))
+
+
+class ReplicaSession(Session):
+    def __init__(self, registry, host='replica'):
+        super().__init__()
+        self.registry = registry
+        self.host = host
+
+    def enter_contexts(self):
+        self.db = yield self.registry(connect, self.host)
+
+
+REPLICA = "{}.connect('replica',)".format(__name__)
+OTHER = "{}.connect('other',)".format(__name__)
+
+
+@pytest.fixture(autouse=True)
+def clear_log():
+    del log[:]
+
+
+def test_shared_across_sessions():
+    registry = SharedResources()
+    with ReplicaSession(registry) as s1:
+        with ReplicaSession(registry) as s2, \
+                ReplicaSession(registry, 'other') as s3:
+            assert s1.db is s2.db and s1.db is not s3.db
+            assert registry.shares == {REPLICA: 2, OTHER: 1}
+        assert log == [('connect', 'replica'), ('connect', 'other'),
+                       ('close', 'other')]
+        assert registry.stats()[REPLICA] == {
+            'holders': 1, 'peak': 2, 'acquired': 2, 'lingering': False}
+
+    assert log[-1] == ('close', 'replica')
+    assert registry.shares == {}
+
+
+def test_linger():
+    registry = SharedResources(linger=0.05)
+    with ReplicaSession(registry) as s1:
+        db = s1.db
+    with ReplicaSession(registry) as s2:
+        assert s2.db is db
+    assert registry.stats()[REPLICA]['lingering']
+    assert log == [('connect', 'replica')]
+
+    time.sleep(0.1)
+    assert log[-1] == ('close', 'replica') and registry.shares == {}
+
+    ReplicaSession(registry).open().close()
+    registry.close()
+    assert log[-1] == ('close', 'replica') and len(log) == 4
+
+
+def test_concurrent_first_use():
+    registry = SharedResources()
+    entered = threading.Event()
+    release = threading.Event()
+
+    @contextmanager
+    def slow():
+        entered.set()
+        release.wait(5)
+        yield object()
+
+    values = []
+
+    def use():
+        with Session(registry(slow)) as s:
+            values.append(registry.shares)
+
+    threads = [threading.Thread(target=use) for _ in range(4)]
+    threads[0].start()
+    entered.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert len(values) == 4 and registry.shares == {}
+
+
+def test_reused_handle():
+    registry = SharedResources()
+    handle = registry(connect, 'replica')
+    with Session(handle) as s1:
+        with Session(handle) as s2:
+            assert registry.shares == {REPLICA: 2}
+        assert registry.shares == {REPLICA: 1} and len(log) == 1
+    assert registry.shares == {} and log[-1] == ('close', 'replica')
+
+
+def test_default_registry():
+    assert isinstance(shared_resources, SharedResources)
+    assert sessionlib.shared.shared_resources is shared_resources
+
+
+def test_failed_enter():
+    registry = SharedResources()
+
+    @contextmanager
+    def broken():
+        raise ValueError('boom')
+        yield
+
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            registry(broken).__enter__()
+    assert registry.shares == {}
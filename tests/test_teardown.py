@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import threading
+
+import pytest
+
+from sessionlib import Session, TeardownWorker
+from contextlib import contextmanager, asynccontextmanager
+
+
+class SlowSession(Session):
+    def __init__(self, log, release=None):
+        super().__init__()
+        self.log = log
+        self.release = release
+
+    def enter_contexts(self):
+        yield self.resource()
+
+    @contextmanager
+    def resource(self):
+        yield
+        if self.release is not None:
+            self.release.wait(5)
+        self.log.append(threading.current_thread().name)
+
+
+def test_background_close():
+    log = []
+    release = threading.Event()
+    session = SlowSession(log, release)
+    session.on_close.subscribe(lambda: log.append('on_close'))
+
+    session.open()
+    handle = session.close(background=True)
+    assert not session.opened
+    assert Session.current() is None
+    assert not handle.done()
+
+    # No re-entry while the teardown is in flight.
+    with pytest.raises(RuntimeError):
+        session.open()
+
+    release.set()
+    handle.result(5)
+    assert log[0] == 'on_close'
+    assert log[1].startswith('sessionlib-teardown')
+
+    # Only the final close is handed over.
+    with session:
+        session.open()
+        assert session.close(background=True) is None
+        assert session.opened
+
+
+def test_background_close_errors():
+    class FailingSession(Session):
+        @contextmanager
+        def resource(self):
+            yield
+            raise ValueError('boom')
+
+        def enter_contexts(self):
+            yield self.resource()
+
+    worker = TeardownWorker()
+    session = FailingSession().open()
+    handle = session.close(background=worker)
+    with pytest.raises(ValueError):
+        handle.result(5)
+    assert worker.drain(5)
+    assert worker.stats['failed'] == 1
+    worker.shutdown()
+
+
+def test_background_close_after_shutdown():
+    log = []
+    worker = TeardownWorker()
+    worker.shutdown()
+
+    session = SlowSession(log).open()
+    handle = session.close(background=worker)
+    assert handle.done() and handle.exception() is None
+    assert log == [threading.current_thread().name]
+
+    async def main():
+        session = SlowSession(log).open()
+        await (await session.aclose(background=worker))
+
+    asyncio.run(main())
+    assert len(log) == 2
+    with session:
+        pass
+
+
+def test_backpressure():
+    log = []
+    release = threading.Event()
+    worker = TeardownWorker(max_pending=1, timeout=0.01)
+
+    blocked = [SlowSession(log, release).open() for _ in range(2)]
+    handles = [s.close(background=worker) for s in blocked]
+
+    # Queue full: the caller runs the teardown itself.
+    inline = SlowSession(log).open()
+    handle = inline.close(background=worker)
+    assert handle.done()
+    assert log == [threading.current_thread().name]
+    assert worker.stats['inline'] == 1
+
+    assert not worker.drain(0.01)
+    release.set()
+    assert worker.drain(5)
+    assert all(h.done() for h in handles)
+    assert worker.stats['pending'] == 0
+    worker.shutdown()
+
+
+def test_async_background_close():
+    log = []
+
+    class AsyncSession(Session):
+        def enter_contexts(self):
+            yield self.resource()
+
+        @asynccontextmanager
+        async def resource(self):
+            yield
+            await asyncio.sleep(0.01)
+            log.append('closed')
+
+    async def main():
+        session = await AsyncSession().aopen()
+        task = await session.aclose(background=True)
+        assert not session.opened and log == []
+        with pytest.raises(RuntimeError):
+            await session.aopen()
+        await task
+        assert log == ['closed']
+
+        sync_session = SlowSession(log).open()
+        await (await sync_session.aclose(background=True))
+        assert log[-1].startswith('sessionlib-teardown')
+
+    asyncio.run(main())
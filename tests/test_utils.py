@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import gc
+
+from functools import partial
+
+import pytest
+
+from sessionlib.utils import Observable
+
+
+def test_calling_conventions():
+    calls = []
+
+    class Handler(object):
+        def no_args(self):
+            calls.append('method')
+
+        def with_obj(self, obj, params=None):
+            calls.append(('method', obj, params))
+
+    handler = Handler()
+    observable = Observable('obj')
+    observable.subscribe(lambda: calls.append('lambda'))
+    observable.subscribe(lambda obj: calls.append(('lambda', obj)))
+    observable.subscribe(handler.no_args)
+    observable.subscribe(handler.with_obj)
+    observable.subscribe(partial(lambda tag, obj: calls.append((tag, obj)),
+                                 'partial'))
+    observable.subscribe(calls.append)
+
+    observable()
+    assert calls == ['lambda', ('lambda', 'obj'), 'method',
+                     ('method', 'obj', None), ('partial', 'obj'), 'obj']
+
+    del calls[:]
+    observable('params')
+    assert calls[3] == ('method', 'obj', 'params')
+
+
+def test_priorities():
+    calls = []
+    observable = Observable()
+    observable.subscribe(lambda: calls.append('low'), priority=-1)
+    observable.subscribe(lambda: calls.append('first'))
+    observable.subscribe(lambda: calls.append('high'), priority=10)
+    observable.subscribe(lambda: calls.append('second'))
+
+    observable()
+    assert calls == ['high', 'first', 'second', 'low']
+
+
+def test_unsubscribe():
+    calls = []
+    observable = Observable()
+    callback = lambda: calls.append('callback')
+    handle = observable.subscribe(lambda: calls.append('handle'))
+    observable.subscribe(callback)
+
+    handle.unsubscribe()
+    assert not handle.active
+    handle.unsubscribe()
+    observable()
+    assert calls == ['callback']
+
+    observable.unsubscribe(callback)
+    observable()
+    assert calls == ['callback']
+    assert observable.subscriptions == ()
+
+    with pytest.raises(ValueError):
+        observable.unsubscribe(callback)
+
+
+def test_weak_subscribers():
+    calls = []
+
+    class Handler(object):
+        def __call__(self):
+            calls.append('call')
+
+        def method(self):
+            calls.append('method')
+
+    handler = Handler()
+    observable = Observable()
+    observable.subscribe(handler, weak=True)
+    observable.subscribe(handler.method, weak=True)
+    observable()
+    assert calls == ['call', 'method']
+
+    del handler
+    gc.collect()
+    assert observable.subscriptions == ()
+    observable()
+    assert calls == ['call', 'method']